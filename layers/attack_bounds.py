@@ -0,0 +1,178 @@
+#  Copyright 2022 Hanwen Zhang
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  Unless required by applicable law or agreed to in writing, software.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Bounds of attack graph generation, trading completeness for predictable latency.
+Including class AttackBounds
+"""
+
+
+class AttackBounds:
+    """
+    Bounds of a depth first search, see bounded_depth_first_search(), and how much the search is truncated by them.
+    Properties:
+        max_depth: the most edges from a start state to an expanded attack state, 0 is unbounded
+        
+        edge_budget: the most edges of an attack graph, 0 is unbounded
+        
+        beam_width: the most exploits with the highest CVSS scores followed from an attack state, 0 is unbounded
+        
+        truncated_states: the number of attack states reached but never expanded
+        
+        truncated_edges: the number of edges not added, by beam_width or edge_budget
+    """
+    
+    def __init__(self, max_depth: int, edge_budget: int, beam_width: int):
+        """
+        Parameters:
+            max_depth: the most edges from a start state to an expanded attack state, 0 is unbounded
+            edge_budget: the most edges of an attack graph, 0 is unbounded
+            beam_width: the most exploits with the highest CVSS scores followed from an attack state, 0 is unbounded
+        """
+        
+        self._max_depth = max_depth
+        self._edge_budget = edge_budget
+        self._beam_width = beam_width
+        
+        # Edges are kept as sets of start and end vertices, since the search drops the same edges
+        # each time it pops the same attack state, and may add an edge dropped from another attack state.
+        self._edges: set[(int, int)] = set()
+        self._truncated_edges: set[(int, int)] = set()
+        self._depths: dict[(str, int), int] = dict()
+        self._expanded_states: set[(str, int)] = set()
+        self._truncated_states: set[(str, int)] = set()
+    
+    @property
+    def max_depth(self) -> int:
+        """
+        Returns:
+            the most edges from a start state to an expanded attack state, 0 is unbounded
+        """
+        return self._max_depth
+    
+    @property
+    def edge_budget(self) -> int:
+        """
+        Returns:
+            the most edges of an attack graph, 0 is unbounded
+        """
+        return self._edge_budget
+    
+    @property
+    def beam_width(self) -> int:
+        """
+        Returns:
+            the most exploits with the highest CVSS scores followed from an attack state, 0 is unbounded
+        """
+        return self._beam_width
+    
+    @property
+    def truncated_states(self) -> int:
+        """
+        Returns:
+            the number of attack states reached but never expanded
+        """
+        return len(self._truncated_states - self._expanded_states)
+    
+    @property
+    def truncated_edges(self) -> int:
+        """
+        Returns:
+            the number of edges not added, by beam_width or edge_budget
+        """
+        return len(self._truncated_edges - self._edges)
+    
+    def new_search(self) -> 'AttackBounds':
+        """
+        Returns:
+            bounds with the same limits, for a new attack graph
+        """
+        return AttackBounds(self.max_depth, self.edge_budget, self.beam_width)
+    
+    def start(self, attack_state: (str, int)):
+        """
+        Mark an attack state where the search starts, at depth 0
+        Parameters:
+            attack_state: like ('service1', 4)
+        """
+        self._depths[attack_state] = 0
+    
+    def expand(self, attack_state: (str, int)) -> bool:
+        """
+        Check if an attack state popped by the search is within bounds
+        Parameters:
+            attack_state: like ('service1', 4)
+        Returns:
+            True if the state should be expanded, otherwise it is counted as truncated
+        """
+        
+        if (0 < self.max_depth < self._depths.get(attack_state, 0)) or self.is_exhausted():
+            self._truncated_states.add(attack_state)
+            return False
+        
+        self._expanded_states.add(attack_state)
+        return True
+    
+    def select(self, start_attack_vertex: int, exploits: list[(str, int, str, int, float)]) \
+            -> list[(str, int, str, int, float)]:
+        """
+        Keep the exploits with the highest CVSS scores within beam_width, where ties keep the order of the search
+        Parameters:
+            start_attack_vertex: encoded attack vertex the exploits start from
+            exploits: neighbours, their pre-conditions, vulnerabilities, encoded end attack vertices,
+                      and CVSS scores of vulnerabilities on the images of neighbours
+        Returns:
+            exploits to follow
+        """
+        
+        if self.beam_width == 0 or len(exploits) <= self.beam_width:
+            return exploits
+        
+        ranked_exploits = sorted(exploits, key=lambda exploit: exploit[4], reverse=True)
+        self._truncated_edges.update((start_attack_vertex, exploit[3]) for exploit in ranked_exploits[self.beam_width:])
+        return ranked_exploits[:self.beam_width]
+    
+    def add_edge(self, label: (int, int)) -> bool:
+        """
+        Count a new edge against edge_budget
+        Parameters:
+            label: encoded start and end vertices of the edge
+        Returns:
+            True if the edge can be added, otherwise it is counted as truncated
+        """
+        
+        if self.is_exhausted():
+            self._truncated_edges.add(label)
+            return False
+        
+        self._edges.add(label)
+        return True
+    
+    def push(self, attack_state: (str, int), next_attack_state: (str, int)):
+        """
+        Record the depth of an attack state pushed by the search, as the shortest one found
+        Parameters:
+            attack_state: the expanded attack state
+            next_attack_state: the pushed attack state
+        """
+        
+        depth = self._depths.get(attack_state, 0) + 1
+        if depth < self._depths.get(next_attack_state, depth + 1):
+            self._depths[next_attack_state] = depth
+    
+    def is_exhausted(self) -> bool:
+        """
+        Returns:
+            True if edge_budget is used up
+        """
+        return 0 < self.edge_budget <= len(self._edges)
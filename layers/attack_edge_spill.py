@@ -0,0 +1,357 @@
+#  Copyright 2022 Hanwen Zhang
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  Unless required by applicable law or agreed to in writing, software.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Spilling of attack edges to disk, while attack graphs are searched.
+Including class SpilledMapping, SpilledStack, AttackEdgeSpill
+"""
+
+import os
+import sqlite3
+import tempfile
+import itertools
+import numpy as np
+from typing import Callable
+from collections import deque
+
+
+class SpilledMapping:
+    """
+    A dict-like mapping keyed by attack edges, where the most recent entries are kept in memory and the rest in SQLite.
+    All entries in memory are written back at once when it is full, and only before a new entry is put in,
+    so values taken out of it can still be changed in place, like exploited_vulnerabilities[label].add().
+    """
+    
+    def __init__(self, connection: sqlite3.Connection, table: str, size: int,
+                 encode: Callable[[object], str], decode: Callable[[str], object]):
+        """
+        Parameters:
+            connection: SQLite connection to spill to
+            table: name of the table
+            size: the most entries kept in memory
+            encode: function converting a value to str
+            decode: function converting str back to a value
+        """
+        
+        self._connection = connection
+        self._table = table
+        self._size = max(1, size)
+        self._encode = encode
+        self._decode = decode
+        self._entries: dict[(int, int), object] = dict()
+        
+        # Edges are iterated by rowid, which keeps the order they are first added, as a dict does.
+        self._connection.execute(f'CREATE TABLE {table} (start_vertex INTEGER, end_vertex INTEGER, value TEXT, '
+                                 f'UNIQUE (start_vertex, end_vertex))')
+    
+    @property
+    def size(self) -> int:
+        """
+        Returns:
+            the most entries kept in memory
+        """
+        return self._size
+    
+    def __contains__(self, key: (int, int)) -> bool:
+        return key in self._entries or self.__load(key)
+    
+    def __getitem__(self, key: (int, int)) -> object:
+        if key in self._entries or self.__load(key):
+            return self._entries[key]
+        raise KeyError(key)
+    
+    def __setitem__(self, key: (int, int), value: object):
+        if key not in self._entries and len(self._entries) >= self._size:
+            self.flush()
+        self._entries[key] = value
+    
+    def __len__(self) -> int:
+        self.flush()
+        return self._connection.execute(f'SELECT COUNT(*) FROM {self._table}').fetchone()[0]
+    
+    def __iter__(self):
+        for (key, _) in self.items():
+            yield key
+    
+    def items(self):
+        """
+        Iterate all entries in the order they are first added
+        Returns:
+            a generator of keys and values
+        """
+        
+        self.flush()
+        cursor = self._connection.execute(f'SELECT start_vertex, end_vertex, value FROM {self._table} ORDER BY rowid')
+        while len(rows := cursor.fetchmany(self._size)) > 0:
+            for (start_vertex, end_vertex, value) in rows:
+                yield (start_vertex, end_vertex), self._decode(value)
+    
+    def flush(self):
+        """
+        Write all entries in memory back to SQLite, and drop them from memory
+        """
+        
+        if len(self._entries) == 0:
+            return
+        
+        self._connection.executemany(f'INSERT INTO {self._table} VALUES (?, ?, ?) '
+                                     f'ON CONFLICT (start_vertex, end_vertex) DO UPDATE SET value = excluded.value',
+                                     [(start_vertex, end_vertex, self._encode(value))
+                                      for ((start_vertex, end_vertex), value) in self._entries.items()])
+        self._entries = dict()
+    
+    def __load(self, key: (int, int)) -> bool:
+        """
+        Load an entry from SQLite into memory
+        Parameters:
+            key: start and end vertices of an edge
+        Returns:
+            True if the entry is found
+        """
+        
+        row = self._connection.execute(f'SELECT value FROM {self._table} WHERE start_vertex = ? AND end_vertex = ?',
+                                       key).fetchone()
+        if row is None:
+            return False
+        
+        if len(self._entries) >= self._size:
+            self.flush()
+        self._entries[key] = self._decode(row[0])
+        return True
+
+
+class SpilledStack:
+    """
+    A stack of attack states, where the top entries are kept in memory and the bottom ones in SQLite.
+    When it is full, the bottom half in memory is written to SQLite, and when it is empty in memory,
+    the top half of size is loaded back, so that pushes and pops around the boundary never hit SQLite each time.
+    """
+    
+    def __init__(self, connection: sqlite3.Connection, table: str, size: int):
+        """
+        Parameters:
+            connection: SQLite connection to spill to
+            table: name of the table
+            size: the most entries kept in memory
+        """
+        
+        self._connection = connection
+        self._table = table
+        self._size = max(2, size)
+        self._entries: list[(str, int)] = list()
+        self._spilled = 0
+        
+        # Entries are pushed and popped by rowid, which always grows from the top of the stack in SQLite.
+        self._connection.execute(f'CREATE TABLE {table} (service TEXT, privilege INTEGER)')
+    
+    def __len__(self) -> int:
+        return len(self._entries) + self._spilled
+    
+    def append(self, attack_state: (str, int)):
+        """
+        Push an attack state
+        Parameters:
+            attack_state: like ('service1', 4)
+        """
+        
+        if len(self._entries) >= self._size:
+            half = len(self._entries) // 2
+            self._connection.executemany(f'INSERT INTO {self._table} VALUES (?, ?)', self._entries[:half])
+            self._entries = self._entries[half:]
+            self._spilled += half
+        self._entries.append(attack_state)
+    
+    def pop(self) -> (str, int):
+        """
+        Pop the attack state pushed last
+        Returns:
+            like ('service1', 4)
+        Raises:
+            IndexError: if the stack is empty
+        """
+        
+        if len(self._entries) == 0 and self._spilled > 0:
+            rows = self._connection.execute(f'SELECT rowid, service, privilege FROM {self._table} '
+                                            f'ORDER BY rowid DESC LIMIT ?', (self._size // 2,)).fetchall()
+            self._connection.execute(f'DELETE FROM {self._table} WHERE rowid >= ?', (rows[-1][0],))
+            self._entries = [(service, privilege) for (_, service, privilege) in reversed(rows)]
+            self._spilled -= len(rows)
+        return self._entries.pop()
+
+
+class AttackEdgeSpill:
+    """
+    Labels and exploited vulnerabilities of a depth first search, see depth_first_search(), and its stack.
+    With a size above 0, they are spilled to a temporary SQLite file, where the size is shared evenly by them,
+    so that searching a large subnet keeps at most size entries in memory. Otherwise, they are plain dicts and a deque.
+    Packed attack edges are still arrays in memory, see pack().
+    It is used as a context manager, which removes the temporary file when the search is done.
+    Properties:
+        labels: labels of the attack graph, keyed by encoded start and end vertices
+        
+        exploited_vulnerabilities: sets of vulnerabilities already exploited on each edge
+        
+        depth_stack: the stack of attack states to expand, which is empty whenever a search is done
+    """
+    
+    def __init__(self, spill_path: str = None, spill_size: int = 0):
+        """
+        Parameters:
+            spill_path: directory of temporary SQLite files
+            spill_size: the most entries kept in memory, 0 never spills to disk
+        """
+        
+        self._spill_file = None
+        self._connection = None
+        
+        if spill_size > 0:
+            os.makedirs(spill_path, exist_ok=True)
+            (descriptor, self._spill_file) = tempfile.mkstemp(suffix='.sqlite', dir=spill_path)
+            os.close(descriptor)
+            
+            # The file is thrown away after the search, so it needs no journal or syncing.
+            self._connection = sqlite3.connect(self._spill_file)
+            self._connection.execute('PRAGMA journal_mode = OFF')
+            self._connection.execute('PRAGMA synchronous = OFF')
+            share = max(1, spill_size // 3)
+            self._labels = SpilledMapping(self._connection, 'labels', share, str, str)
+            self._exploited_vulnerabilities = SpilledMapping(self._connection, 'exploited_vulnerabilities', share,
+                                                             '\n'.join, lambda value: set(value.split('\n')))
+            self._depth_stack = SpilledStack(self._connection, 'depth_stack', share)
+        else:
+            self._labels = dict()
+            self._exploited_vulnerabilities = dict()
+            self._depth_stack = deque()
+    
+    def __enter__(self) -> 'AttackEdgeSpill':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    @property
+    def labels(self) -> dict[(int, int), str] | SpilledMapping:
+        """
+        Returns:
+            labels of the attack graph, keyed by encoded start and end vertices
+        """
+        return self._labels
+    
+    @property
+    def exploited_vulnerabilities(self) -> dict[(int, int), set[str]] | SpilledMapping:
+        """
+        Returns:
+            sets of vulnerabilities already exploited on each edge
+        """
+        return self._exploited_vulnerabilities
+    
+    @property
+    def depth_stack(self) -> deque | SpilledStack:
+        """
+        Returns:
+            the stack of attack states to expand, which is empty whenever a search is done
+        """
+        return self._depth_stack
+    
+    def pack(self, exploitable_vulnerabilities: dict[str, dict[str, dict]], service_ids: dict[str, int]) \
+            -> (np.ndarray, np.ndarray, str, np.ndarray):
+        """
+        Pack labels into flat arrays, streaming over spilled edges in chunks as large as the share of labels in memory.
+        The packed arrays hold all edges, but take a few bytes for each edge besides its label.
+        Parameters:
+            exploitable_vulnerabilities: exploitable vulnerabilities of services at the ends of edges, with their scores
+            service_ids: integer ids of services
+        Returns:
+            edges, label offsets, labels and edge scores, see pack_attack_edges()
+        """
+        
+        if self._connection is None:
+            return pack_attack_edges(self.labels, exploitable_vulnerabilities, service_ids)
+        
+        packed_parts: list[(np.ndarray, np.ndarray, str, np.ndarray)] = \
+            [pack_attack_edges(dict(), exploitable_vulnerabilities, service_ids)]
+        items = self.labels.items()
+        while len(chunk := dict(itertools.islice(items, self.labels.size))) > 0:
+            packed_parts.append(pack_attack_edges(chunk, exploitable_vulnerabilities, service_ids))
+        
+        return concatenate_attack_edges(packed_parts)
+    
+    def close(self):
+        """
+        Close and remove the temporary SQLite file
+        """
+        
+        if self._connection is not None:
+            self._connection.close()
+            os.remove(self._spill_file)
+            self._connection = None
+
+
+def pack_attack_edges(sub_labels: dict[(int, int), str], exploitable_vulnerabilities: dict[str, dict[str, dict]],
+                      service_ids: dict[str, int]) -> (np.ndarray, np.ndarray, str, np.ndarray):
+    """
+    Pack labels of an attack graph into flat arrays, scoring each edge once where it is generated,
+    by CVSS scores of the service it exploits, since images may score the same vulnerability differently.
+    Parameters:
+        sub_labels: labels of the attack graph, keyed by encoded start and end vertices
+        exploitable_vulnerabilities: exploitable vulnerabilities of services at the ends of edges, with their scores
+        service_ids: integer ids of services
+    Returns:
+        edges: int32 array in shape of (n, 2), columns are encoded start and end vertices, service id * 5 + privilege
+        label_offsets: int64 array of n + 1 offsets, the label of edge i is labels[label_offsets[i]:label_offsets[i+1]]
+        labels: all labels concatenated
+        edge_scores: float64 array of n, the highest CVSS score of vulnerabilities of each edge, 0 if none
+    """
+    
+    edges = np.fromiter(itertools.chain.from_iterable(sub_labels), dtype=np.int32,
+                        count=len(sub_labels) * 2).reshape(-1, 2)
+    
+    label_offsets = np.zeros(len(sub_labels) + 1, dtype=np.int64)
+    label_lengths = np.fromiter(map(len, sub_labels.values()), dtype=np.int64, count=len(sub_labels))
+    np.cumsum(label_lengths, out=label_offsets[1:])
+    
+    end_ids = set((edges[:, 1] // 5).tolist())
+    service_scores: dict[int, dict[str, float]] = {service_id: exploitable_vulnerabilities[service]['scores']
+                                                   for (service, service_id) in service_ids.items()
+                                                   if service_id in end_ids}
+    edge_scores = np.fromiter((max([service_scores[end_vertex // 5][vulnerability]
+                                    for vulnerability in label.split('\n') if vulnerability], default=0)
+                               for ((_, end_vertex), label) in sub_labels.items()),
+                              dtype=np.float64, count=len(sub_labels))
+    
+    return edges, label_offsets, ''.join(sub_labels.values()), edge_scores
+
+
+def concatenate_attack_edges(packed_edges: list[(np.ndarray, np.ndarray, str, np.ndarray)]) \
+        -> (np.ndarray, np.ndarray, str, np.ndarray):
+    """
+    Concatenate results of pack_attack_edges() with disjoint edges.
+    Parameters:
+        packed_edges: a list of edges, label offsets, labels and edge scores
+    Returns:
+        edges, label offsets, labels and edge scores
+    """
+    
+    if len(packed_edges) == 1:
+        return packed_edges[0]
+    
+    edges = np.concatenate([part_edges for part_edges, _, _, _ in packed_edges])
+    
+    label_offsets = [np.zeros(1, dtype=np.int64)]
+    start = 0
+    for _, part_offsets, part_labels, _ in packed_edges:
+        label_offsets.append(part_offsets[1:] + start)
+        start += len(part_labels)
+    
+    return edges, np.concatenate(label_offsets), ''.join([part_labels for _, _, part_labels, _ in packed_edges]), \
+        np.concatenate([part_scores for _, _, _, part_scores in packed_edges])
@@ -16,22 +16,38 @@ Layer for manipulation of the attack graphs of subnets.
 Including class AttackGraphLayer
 """
 
+import os
+import copy
+import json
+import math
 import time
+import hashlib
+import zipfile
+import numpy as np
 import networkx as nx
 from collections import deque
 from concurrent.futures import Executor, Future, wait
 
 from layers.topology_layer import TopologyLayer
 from layers.vulnerability_layer import VulnerabilityLayer
+from layers.attack_graph_store import AttackGraphStore
+from layers.attack_bounds import AttackBounds
+from layers.attack_edge_spill import AttackEdgeSpill, pack_attack_edges, concatenate_attack_edges
 
 
 class AttackGraphLayer:
     """
     Encapsulation of attack graphs subnets.
     Properties:
-        attack_graph: a dictionary of nx.DiGraph, where members are attack graphs for a subnet.
+        attack_stores: a dictionary of AttackGraphStore, where members are attack graphs for a subnet.
         
-        graph_labels: labels for attack graphs, containing detailed CVE entries.
+        attack_graph: a dictionary of nx.DiGraph views of attack_stores.
+        
+        graph_labels: labels for attack graphs, containing detailed CVE entries, as views of attack_stores.
+        
+        truncations: numbers of truncated attack states and edges of each attack graph, in the bounded mode
+        
+        executor: concurrent.futures.Executor or None, shared with other layers
         
         vulnerability_layer: VulnerabilityLayer binding
     """
@@ -44,8 +60,8 @@ class AttackGraphLayer:
             executor: concurrent.futures.Executor or None
         """
         
-        self._attack_graph = dict()
-        self._graph_labels = dict()
+        self._attack_stores = dict()
+        self._truncations = dict()
         self._executor = executor
         self._vulnerability_layer = vulnerability_layer
         
@@ -57,21 +73,45 @@ class AttackGraphLayer:
         da = time.time() - start
         print(f'Time for attack graphs of subnets generation: {da} seconds.')
 
+    @property
+    def attack_stores(self) -> dict[str, AttackGraphStore]:
+        """
+        Returns:
+            a dictionary of AttackGraphStore, where members are attack graphs for a subnet.
+        """
+        return self._attack_stores
+    
     @property
     def attack_graph(self) -> dict[str, nx.DiGraph]:
         """
         Returns:
-            a dictionary of nx.DiGraph, where members are attack graphs for a subnet.
+            a dictionary of nx.DiGraph views of attack_stores, built on the first access.
         """
-        return self._attack_graph
+        return {subnet: self.attack_stores[subnet].graph for subnet in self.attack_stores}
     
     @property
     def graph_labels(self) -> dict[str, dict[((str, str), (str, str)), str]]:
         """
         Returns:
-            labels for attack graphs, containing detailed CVE entries.
+            labels for attack graphs, containing detailed CVE entries, built on the first access.
         """
-        return self._graph_labels
+        return {subnet: self.attack_stores[subnet].graph_labels for subnet in self.attack_stores}
+    
+    @property
+    def truncations(self) -> dict[str, (int, int)]:
+        """
+        Returns:
+            numbers of truncated attack states and edges of each attack graph, in the bounded mode
+        """
+        return self._truncations
+    
+    @property
+    def executor(self) -> Executor:
+        """
+        Returns:
+            concurrent.futures.Executor or None, shared with other layers
+        """
+        return self._executor
     
     @property
     def vulnerability_layer(self) -> VulnerabilityLayer:
@@ -81,13 +121,34 @@ class AttackGraphLayer:
         """
         return self._vulnerability_layer
     
-    @attack_graph.setter
-    def attack_graph(self, attack_graph: dict[str, nx.DiGraph]):
-        self._attack_graph = attack_graph
+    @attack_stores.setter
+    def attack_stores(self, attack_stores: dict[str, AttackGraphStore]):
+        self._attack_stores = attack_stores
     
-    @graph_labels.setter
-    def graph_labels(self, graph_labels: dict[str, dict[((str, str), (str, str)), str]]):
-        self._graph_labels = graph_labels
+    def fork(self) -> 'AttackGraphLayer':
+        """
+        Fork the attack graph layer and layers below it, see VulnerabilityLayer.fork().
+        Attack graph stores are forked at once, which share their arrays, and the executor is shared.
+        Returns:
+            an attack graph layer changed apart from this layer
+        """
+        
+        # copy.copy() goes through __getstate__(), which drops the executor.
+        fork = copy.copy(self)
+        fork._executor = self._executor
+        fork._vulnerability_layer = self.vulnerability_layer.fork()
+        service_uids = fork.vulnerability_layer.topology_layer.service_uids
+        fork._attack_stores = {subnet: store.fork(service_uids) for (subnet, store) in self.attack_stores.items()}
+        fork._truncations = dict(self.truncations)
+        return fork
+    
+    def __getstate__(self) -> dict[str]:
+        """
+        Copies sent to workers generate attack graphs in process, since an executor cannot be pickled.
+        """
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
     
     def update_by_subnets(self, affected_subnets: list[str]):
         """
@@ -96,172 +157,1075 @@ class AttackGraphLayer:
             affected_subnets: list of subnets to update attack graph
         """
         
-        futures: list[Future] = list()
-        
         services = self.vulnerability_layer.topology_layer.services
         subnets = self.vulnerability_layer.topology_layer.subnets
+        service_ids = self.vulnerability_layer.topology_layer.service_ids
+        service_uids = self.vulnerability_layer.topology_layer.service_uids
         exploitable_vulnerabilities = self.vulnerability_layer.exploitable_vulnerabilities
         single_exploit = self.vulnerability_layer.config['single-exploit-per-service']
         single_label = self.vulnerability_layer.config['single-edge-label']
+        spill_path = self.vulnerability_layer.config['attack-graph-spill-path']
+        spill_size = self.vulnerability_layer.config['attack-graph-spill-size']
+        bounds = self.__get_bounds()
+        
+        if self._executor is None and 'exposed' in affected_subnets:
+            
+            # Exploiting a service only once, or a bounded search, depends on the search order,
+            # so it needs the search over the network.
+            if single_exploit or bounds is not None:
+                packed_edges = generate_full_from_exposed(services, exploitable_vulnerabilities, subnets, service_ids,
+                                                          single_exploit, single_label, spill_path, spill_size,
+                                                          bounds)
+                self.truncations['full'] = (bounds.truncated_states, bounds.truncated_edges) \
+                    if bounds is not None else (0, 0)
+            else:
+                packed_edges = generate_hierarchical_from_exposed(services, subnets, service_ids,
+                                                                  exploitable_vulnerabilities, single_label,
+                                                                  spill_path, spill_size)
+            self.attack_stores['full'] = AttackGraphStore(service_uids)
+            self.attack_stores['full'].add_edges(*packed_edges)
         
-        if self._executor is not None:
-            for subnet in affected_subnets:
-                future = self._executor.submit(generate_sub_graph, services, subnets, subnet,
-                                               exploitable_vulnerabilities, single_exploit, single_label)
-                future.add_done_callback(update(self.attack_graph, self.graph_labels, subnet))
-                futures.append(future)
-
-        elif 'exposed' in affected_subnets:
-            composed_graph, composed_labels = generate_full_from_exposed(services, exploitable_vulnerabilities,
-                                                                         subnets, single_exploit, single_label)
-            self.attack_graph['full'] = composed_graph
-            self.graph_labels['full'] = composed_labels
-
         else:
-            for subnet in affected_subnets:
-                sub_graph, sub_labels = \
-                    generate_sub_graph(services, subnets, subnet, exploitable_vulnerabilities,
-                                       single_exploit, single_label)
-                self.attack_graph[subnet] = sub_graph
-                self.graph_labels[subnet] = sub_labels
-
-        if self._executor is not None:
-            wait(futures)
+            packed_subnets: dict[str, (np.ndarray, np.ndarray, str, np.ndarray)] = dict()
+            
+            cache_path = self.vulnerability_layer.config['attack-graph-cache-path']
+            cache_size = self.vulnerability_layer.config['attack-graph-cache-size']
+            signatures: dict[str, str] = dict()
+            
+            # Bounded attack graphs are not cached, since their truncations would be lost.
+            if cache_size > 0 and bounds is None:
+                for subnet in affected_subnets:
+                    signatures[subnet] = get_subnet_signature(subnets, subnet, exploitable_vulnerabilities,
+                                                              single_exploit, single_label)
+                    packed_edges = load_cached_sub_graph(cache_path, signatures[subnet], service_ids)
+                    if packed_edges is not None:
+                        packed_subnets[subnet] = packed_edges
+                print(f'Loaded attack graphs of {len(packed_subnets)} subnets from cache.')
+            
+            costs = {subnet: estimate_subnet_cost(subnets, subnet, exploitable_vulnerabilities)
+                     for subnet in affected_subnets if subnet not in packed_subnets}
+            
+            if self._executor is None \
+                    or sum(costs.values()) < self.vulnerability_layer.config['in-process-cost-threshold']:
+                for subnet in costs:
+                    subnet_bounds = bounds.new_search() if bounds is not None else None
+                    packed_subnets[subnet] = generate_sub_graph(services, subnets, subnet, service_ids,
+                                                                exploitable_vulnerabilities, single_exploit,
+                                                                single_label, spill_path, spill_size, subnet_bounds)
+                    if subnet_bounds is not None:
+                        self.truncations[subnet] = (subnet_bounds.truncated_states, subnet_bounds.truncated_edges)
+            
+            else:
+                futures = self.__submit_subnet_tasks(costs, bounds)
+                wait([future for (_, future) in futures])
+                
+                # Graphs are assembled here rather than in done callbacks,
+                # since callbacks may still be running when wait() returns.
+                packed_parts: dict[str, list[(np.ndarray, np.ndarray, str, np.ndarray)]] = \
+                    {subnet: [] for subnet in costs}
+                for task_subnets, future in futures:
+                    for subnet, (packed_edges, truncation) in zip(task_subnets, future.result()):
+                        packed_parts[subnet].append(packed_edges)
+                        if bounds is not None:
+                            self.truncations[subnet] = truncation
+                
+                for subnet in packed_parts:
+                    packed_subnets[subnet] = concatenate_attack_edges(packed_parts[subnet])
+            
+            for subnet in signatures:
+                if subnet in costs:
+                    store_cached_sub_graph(cache_path, cache_size, signatures[subnet], packed_subnets[subnet],
+                                           service_uids)
+            
+            for subnet in packed_subnets:
+                self.attack_stores[subnet] = AttackGraphStore(service_uids)
+                self.attack_stores[subnet].add_edges(*packed_subnets[subnet])
+        
+        for subnet in [*self.attack_stores.keys()]:
+            if self.attack_stores[subnet].number_of_edges() == 0:
+                del self.attack_stores[subnet]
+        
+        if bounds is not None:
+            truncated_states = sum([truncated_states for (truncated_states, _) in self.truncations.values()])
+            truncated_edges = sum([truncated_edges for (_, truncated_edges) in self.truncations.values()])
+            print(f'Bounded generation truncated {truncated_states} attack states and {truncated_edges} edges.')
+    
+    def add_service(self, uid: str):
+        """
+        Patch attack graphs of the subnets of a new service in place, rather than regenerating them.
+        Only edges into the service, and edges from attack states newly reachable through it are generated.
+        The service should already be in the topology layer and the vulnerability layer.
+        Parameters:
+            uid: uid of the new service
+        """
+        
+        services = self.vulnerability_layer.topology_layer.services
+        subnets = self.vulnerability_layer.topology_layer.subnets
+        service_ids = self.vulnerability_layer.topology_layer.service_ids
+        service_uids = self.vulnerability_layer.topology_layer.service_uids
+        exploitable_vulnerabilities = self.vulnerability_layer.exploitable_vulnerabilities
+        single_label = self.vulnerability_layer.config['single-edge-label']
+        
+        if not self.__is_patchable():
+            self.update_by_subnets(services[uid]['subnets'])
+            return
+        
+        for subnet in services[uid]['subnets']:
+            
+            store = self.attack_stores.get(subnet, AttackGraphStore(service_uids))
+            (_, out_degrees) = store.get_degrees()
+            new_labels: dict[(int, int), str] = dict()
+            exploited_vulnerabilities: dict[(int, int), set[str]] = dict()
+            
+            # Edges of a state only depend on the state, so expanded states only need edges into the new service.
+            for (service, current_privilege) in get_attack_states(subnets, subnet, exploitable_vulnerabilities,
+                                                                  single_label):
+                
+                attack_vertex = service_ids[service] * 5 + current_privilege
+                if attack_vertex < len(out_degrees) and out_degrees[attack_vertex] > 0:
+                    neighbours = {uid}
+                else:
+                    neighbours = subnets[subnet]['services']
+                
+                depth_stack = deque()
+                depth_stack.append((service, current_privilege))
+                depth_first_search(set(), exploited_vulnerabilities, services, subnets, service_ids,
+                                   exploitable_vulnerabilities, new_labels, depth_stack, False, single_label,
+                                   neighbours)
+            
+            store.add_edges(*pack_attack_edges(new_labels, exploitable_vulnerabilities, service_ids))
+            
+            if store.number_of_edges() > 0:
+                self.attack_stores[subnet] = store
+    
+    def remove_service(self, uid: str, affected_subnets: list[str]):
+        """
+        Patch attack graphs of the subnets of a removed service in place, rather than regenerating them.
+        Edges of the service, and edges from attack states only reachable through it are removed.
+        The service should already be removed from the topology layer.
+        Parameters:
+            uid: uid of the removed service
+            affected_subnets: subnets where the service was
+        """
+        
+        subnets = self.vulnerability_layer.topology_layer.subnets
+        service_ids = self.vulnerability_layer.topology_layer.service_ids
+        exploitable_vulnerabilities = self.vulnerability_layer.exploitable_vulnerabilities
+        single_label = self.vulnerability_layer.config['single-edge-label']
+        
+        if not self.__is_patchable():
+            self.update_by_subnets(affected_subnets)
+            return
+        
+        for subnet in affected_subnets:
+            
+            if subnet not in self.attack_stores:
+                continue
+            
+            store = self.attack_stores[subnet]
+            edge_vertices = store.edges
+            attack_vertices = np.array([service_ids[service] * 5 + current_privilege for (service, current_privilege)
+                                        in get_attack_states(subnets, subnet, exploitable_vulnerabilities,
+                                                             single_label)], dtype=np.int64)
+            
+            # Edges of the service, and edges starting from states no longer reachable.
+            edges_to_remove = (edge_vertices // 5 == service_ids[uid]).any(axis=1) \
+                | ~np.isin(edge_vertices[:, 0], attack_vertices)
+            touched_vertices = np.unique(edge_vertices[edges_to_remove])
+            store.remove_edges(edges_to_remove)
+            
+            (in_degrees, out_degrees) = store.get_degrees()
+            store.remove_vertices(touched_vertices[in_degrees[touched_vertices] + out_degrees[touched_vertices] == 0])
+            
+            if store.number_of_edges() == 0:
+                del self.attack_stores[subnet]
+    
+    def __is_patchable(self) -> bool:
+        """
+        If attack graphs of subnets can be patched in place.
+        A full attack graph from exposed services, or exploiting a service only once, depends on the search order.
+        Returns:
+            True if add_service() and remove_service() can patch attack graphs in place
+        """
+        return 'full' not in self.attack_stores and not self.vulnerability_layer.config['single-exploit-per-service'] \
+            and self.__get_bounds() is None
+    
+    def __get_bounds(self) -> AttackBounds:
+        """
+        Bounds of attack graph generation from the config.
+        Returns:
+            AttackBounds, or None if the generation is exhaustive
+        """
+        
+        config = self.vulnerability_layer.config
+        if config['max-attack-depth'] == 0 and config['attack-edge-budget'] == 0 and config['attack-beam-width'] == 0:
+            return None
+        
+        return AttackBounds(config['max-attack-depth'], config['attack-edge-budget'], config['attack-beam-width'])
+    
+    def __submit_subnet_tasks(self, costs: dict[str, int], bounds: AttackBounds = None) -> list[(list[str], Future)]:
+        """
+        Schedule attack graph generations of subnets to the executor.
+        Subnets taking more than their share of the pool are split into tasks by attack states,
+        tiny subnets are batched into one task to save IPC, and the largest tasks are submitted first.
+        Parameters:
+            costs: estimated costs of subnets to update, see estimate_subnet_cost()
+            bounds: bounds of the generation, or None
+        Returns:
+            a list of subnets of each task and its future
+        """
         
-        for subnet in [*self.graph_labels.keys()]:
-            if len(self.graph_labels[subnet]) == 0:
-                del self.graph_labels[subnet]
-                del self.attack_graph[subnet]
+        services = self.vulnerability_layer.topology_layer.services
+        subnets = self.vulnerability_layer.topology_layer.subnets
+        service_ids = self.vulnerability_layer.topology_layer.service_ids
+        exploitable_vulnerabilities = self.vulnerability_layer.exploitable_vulnerabilities
+        single_exploit = self.vulnerability_layer.config['single-exploit-per-service']
+        single_label = self.vulnerability_layer.config['single-edge-label']
+        spill_path = self.vulnerability_layer.config['attack-graph-spill-path']
+        spill_size = self.vulnerability_layer.config['attack-graph-spill-size']
+        workers = max(1, self.vulnerability_layer.config['nums-of-processes'])
+        
+        total_cost = sum(costs.values())
+        
+        # Around 4 tasks per worker keeps the pool balanced without paying too much for IPC.
+        batch_cost = total_cost / (workers * 4)
+        
+        tasks: list[(float, list[str], list[(str, int)])] = list()
+        batch: list[str] = list()
+        batched_cost = 0
+        
+        for subnet in sorted(costs, key=costs.get, reverse=True):
+            
+            # Splitting is exact only if every reachable state is expanded,
+            # which is not the case when a service is exploited only once, or the search is bounded.
+            parts = 1
+            if not single_exploit and bounds is None and total_cost > 0:
+                parts = min(workers, math.ceil(costs[subnet] * workers / total_cost))
+            
+            if parts > 1:
+                attack_states = get_attack_states(subnets, subnet, exploitable_vulnerabilities, single_label)
+                for part in range(parts):
+                    tasks.append((costs[subnet] / parts, [subnet], attack_states[part::parts]))
+            
+            elif costs[subnet] >= batch_cost:
+                tasks.append((costs[subnet], [subnet], None))
+            
+            else:
+                batch.append(subnet)
+                batched_cost += costs[subnet]
+                if batched_cost >= batch_cost:
+                    tasks.append((batched_cost, batch, None))
+                    batch = list()
+                    batched_cost = 0
+        
+        if len(batch) > 0:
+            tasks.append((batched_cost, batch, None))
+        
+        tasks.sort(key=lambda task: task[0], reverse=True)
+        
+        futures: list[(list[str], Future)] = list()
+        for _, task_subnets, attack_states in tasks:
+            future = self._executor.submit(generate_sub_graphs, services, subnets, task_subnets, service_ids,
+                                           exploitable_vulnerabilities, single_exploit, single_label, attack_states,
+                                           spill_path, spill_size, bounds)
+            futures.append((task_subnets, future))
+        
+        return futures
+    
+    def find_attack_path(self, to_n: str, privilege: str = 'ADMIN', from_n: str = 'outside',
+                         bidirectional: bool = False) -> list[((str, str), (str, str), str)]:
+        """
+        Search if an attacker from from_n can get a privilege on to_n, without generating any attack graph.
+        The search runs over attack states of services and privileges, and stops as soon as to_n is reached.
+        Parameters:
+            to_n: the target service
+            privilege: the least privilege to get on to_n, default: 'ADMIN'
+            from_n: where the attacker starts with 'ADMIN', default: 'outside'
+            bidirectional: if True, also search backwards from to_n, and stop where both searches meet
+        Returns:
+            a witness path as a list of attack edges and their vulnerabilities, like
+            [(('outside', 'ADMIN'), ('service1', 'USER'), 'CVE-2022-0001'), ...], or None if to_n is unreachable
+        Raises:
+            ValueError: if from_n or to_n is not a service
+        """
+        
+        topology_layer = self.vulnerability_layer.topology_layer
+        services = topology_layer.services
+        subnets = topology_layer.subnets
+        exploitable_vulnerabilities = self.vulnerability_layer.exploitable_vulnerabilities
+        single_label = self.vulnerability_layer.config['single-edge-label']
+        
+        if from_n != 'outside' and from_n not in services:
+            raise ValueError(f'Start service {from_n} is not in the topology.')
+        
+        if to_n not in services:
+            raise ValueError(f'End service {to_n} is not in the topology.')
+        
+        # The least pre-condition on to_n, with which a vulnerability gives the privilege.
+        goal_privilege = VulnerabilityLayer.get_privilege_value(privilege)
+        goal_vulnerability = None
+        goal_pre_condition = None
+        for pre_condition in range(0, 5):
+            for vulnerability in exploitable_vulnerabilities[to_n]['pre_values'][pre_condition]:
+                if goal_vulnerability is None \
+                        and exploitable_vulnerabilities[to_n]['post_conditions'][vulnerability] >= goal_privilege:
+                    goal_vulnerability = vulnerability
+                    goal_pre_condition = pre_condition
+        
+        if goal_vulnerability is None:
+            return None
+        
+        transitions: dict[(str, int), dict[int, str]] = dict()
+        
+        def get_transitions(service: str, current_privilege: int) -> dict[int, str]:
+            """
+            Cached get_next_privileges() of a service
+            """
+            if (service, current_privilege) not in transitions:
+                transitions[(service, current_privilege)] = \
+                    get_next_privileges(exploitable_vulnerabilities[service], current_privilege, single_label)
+            return transitions[(service, current_privilege)]
+        
+        def is_attack_state(service: str, current_privilege: int) -> bool:
+            """
+            If any search from from_n could push the state
+            """
+            if service == from_n and current_privilege == 4:
+                return True
+            return service != 'outside' and current_privilege in get_transitions(service, 4)
+        
+        goal_neighbours = TopologyLayer.get_neighbours(services, subnets, to_n)
+        start_state = (from_n, 4)
+        
+        # Forward parents are like {state: (previous state, vulnerability)},
+        # backward parents are like {state: (next state, vulnerability)}, where None means to_n is reached.
+        forward_parents: dict[(str, int), ((str, int), str)] = {start_state: None}
+        backward_parents: dict[(str, int), ((str, int), str)] = dict()
+        forward_queue = deque([start_state])
+        backward_queue = deque()
+        
+        if bidirectional:
+            for neighbour in goal_neighbours:
+                for current_privilege in range(goal_pre_condition, 5):
+                    if is_attack_state(neighbour, current_privilege):
+                        backward_parents[(neighbour, current_privilege)] = None
+                        backward_queue.append((neighbour, current_privilege))
+        
+        def is_goal_state(state: (str, int)) -> bool:
+            """
+            If to_n is exploitable from the state, or the backward search has reached it
+            """
+            (service, current_privilege) = state
+            return state in backward_parents or (service in goal_neighbours and current_privilege >= goal_pre_condition)
+        
+        meeting_state = start_state if is_goal_state(start_state) else None
+        
+        def get_subnets(service: str) -> list[str]:
+            """
+            Subnets of a service, where 'outside' is only in 'exposed'
+            """
+            return services[service]['subnets'] if service != 'outside' else ['exposed']
+        
+        # All members of a subnet share its services as neighbours,
+        # so a subnet is only expanded once with each privilege, whichever member reaches it first.
+        forward_expanded: set[(str, int)] = set()
+        backward_expanded: set[(str, int)] = set()
+        
+        # States are checked when they are found rather than expanded, to stop as early as possible.
+        # Once the backward search is exhausted, it has found every state that reaches to_n,
+        # and the forward search goes on alone until it meets one of them.
+        while meeting_state is None and len(forward_queue) > 0:
+            
+            if len(backward_queue) == 0 or len(forward_queue) <= len(backward_queue):
+                
+                state = forward_queue.popleft()
+                (service, current_privilege) = state
+                
+                for subnet in get_subnets(service):
+                    if (subnet, current_privilege) in forward_expanded:
+                        continue
+                    forward_expanded.add((subnet, current_privilege))
+                    for neighbour in subnets[subnet]['services']:
+                        if neighbour == 'outside':
+                            continue
+                        for next_privilege, vulnerability in get_transitions(neighbour, current_privilege).items():
+                            next_state = (neighbour, next_privilege)
+                            if next_state not in forward_parents:
+                                forward_parents[next_state] = (state, vulnerability)
+                                forward_queue.append(next_state)
+                                if meeting_state is None and is_goal_state(next_state):
+                                    meeting_state = next_state
+            
+            else:
+                
+                state = backward_queue.popleft()
+                (service, state_privilege) = state
+                
+                for current_privilege in range(state_privilege, 5):
+                    if state_privilege not in get_transitions(service, current_privilege):
+                        continue
+                    vulnerability = get_transitions(service, current_privilege)[state_privilege]
+                    for subnet in get_subnets(service):
+                        if (subnet, current_privilege) in backward_expanded:
+                            continue
+                        backward_expanded.add((subnet, current_privilege))
+                        for neighbour in subnets[subnet]['services']:
+                            previous_state = (neighbour, current_privilege)
+                            if previous_state not in backward_parents and is_attack_state(neighbour, current_privilege):
+                                backward_parents[previous_state] = (state, vulnerability)
+                                backward_queue.append(previous_state)
+                                if meeting_state is None and previous_state in forward_parents:
+                                    meeting_state = previous_state
+        
+        if meeting_state is None:
+            return None
+        
+        def get_attack_edge(start_state: (str, int), end_service: str, vulnerability: str) \
+                -> ((str, str), (str, str), str):
+            """
+            Attack edge of exploiting a vulnerability of end_service from start_state
+            """
+            (start_service, current_privilege) = start_state
+            post_condition = exploitable_vulnerabilities[end_service]['post_conditions'][vulnerability]
+            return ((start_service, VulnerabilityLayer.get_privilege_str(current_privilege)),
+                    (end_service, VulnerabilityLayer.get_privilege_str(post_condition)), vulnerability)
+        
+        attack_path = deque()
+        
+        state = meeting_state
+        while forward_parents[state] is not None:
+            (previous_state, vulnerability) = forward_parents[state]
+            attack_path.appendleft(get_attack_edge(previous_state, state[0], vulnerability))
+            state = previous_state
+        
+        state = meeting_state
+        while backward_parents.get(state) is not None:
+            (next_state, vulnerability) = backward_parents[state]
+            attack_path.append(get_attack_edge(state, next_state[0], vulnerability))
+            state = next_state
+        
+        attack_path.append(get_attack_edge(state, to_n, goal_vulnerability))
+        return [*attack_path]
+    
+    @staticmethod
+    def summarise_exposure(vulnerability_layer: VulnerabilityLayer, from_n: str = 'outside') -> np.ndarray:
+        """
+        Get the highest privilege an attacker from from_n can get on each service, without generating any attack graph.
+        Privileges of subnets are raised to a fixpoint, so it is fast enough to be a pre-check before generation.
+        The result is the closure of attack states, as if every service could be exploited as much as possible.
+        Parameters:
+            vulnerability_layer: VulnerabilityLayer binding
+            from_n: where the attacker starts with 'ADMIN', default: 'outside'
+        Returns:
+            an int8 array indexed by TopologyLayer.service_ids, where -1 means the service is unreachable
+        Raises:
+            ValueError: if from_n is not a service
+        """
+        
+        ts = time.time()
+        
+        topology_layer = vulnerability_layer.topology_layer
+        services = topology_layer.services
+        subnets = topology_layer.subnets
+        service_ids = topology_layer.service_ids
+        exploitable_vulnerabilities = vulnerability_layer.exploitable_vulnerabilities
+        single_label = vulnerability_layer.config['single-edge-label']
+        
+        if from_n != 'outside' and from_n not in services:
+            raise ValueError(f'Start service {from_n} is not in the topology.')
+        
+        # Rows are service ids, and columns are privileges of the attacker on a neighbour.
+        # next_levels has the highest privilege of attack states pushed on the service, and max_posts the highest post.
+        next_levels = np.full((len(topology_layer.service_uids), 5), -1, dtype=np.int8)
+        max_posts = np.full((len(topology_layer.service_uids), 5), -1, dtype=np.int8)
+        for service in services:
+            next_levels[service_ids[service]], max_posts[service_ids[service]] = \
+                get_exposure_tables(exploitable_vulnerabilities[service], single_label)
+        
+        # Privilege of the attacker on each service, and the highest of them in each subnet.
+        # Every member of a subnet is reachable from its highest attack state, since get_next_privileges() is monotone.
+        state_levels = np.full(len(topology_layer.service_uids), -1, dtype=np.int8)
+        subnet_levels: dict[str, int] = {subnet: -1 for subnet in subnets}
+        admin = VulnerabilityLayer.get_privilege_value('ADMIN')
+        
+        state_levels[service_ids[from_n]] = admin
+        pending_subnets = deque(services[from_n]['subnets'] if from_n != 'outside' else ['exposed'])
+        for subnet in pending_subnets:
+            subnet_levels[subnet] = admin
+        
+        while len(pending_subnets) > 0:
+            
+            subnet = pending_subnets.popleft()
+            members = [member for member in subnets[subnet]['services'] if member != 'outside']
+            member_ids = np.array([service_ids[member] for member in members], dtype=np.int64)
+            
+            levels = next_levels[member_ids, subnet_levels[subnet]]
+            raised = np.flatnonzero(levels > state_levels[member_ids])
+            state_levels[member_ids[raised]] = levels[raised]
+            
+            for index in raised:
+                for member_subnet in services[members[index]]['subnets']:
+                    if levels[index] > subnet_levels[member_subnet]:
+                        subnet_levels[member_subnet] = int(levels[index])
+                        pending_subnets.append(member_subnet)
+        
+        # The highest privilege on a service comes from the highest attack state in any of its subnets.
+        exposure = np.full(len(topology_layer.service_uids), -1, dtype=np.int8)
+        for service in services:
+            neighbour_level = max(subnet_levels[subnet] for subnet in services[service]['subnets'])
+            if neighbour_level >= 0:
+                exposure[service_ids[service]] = max_posts[service_ids[service], neighbour_level]
+        exposure[service_ids[from_n]] = admin
+        
+        print(f'Time for exposure summary: {time.time() - ts} seconds.')
+        return exposure
 
 
-def update(attack_graph: dict[str, nx.DiGraph], graph_labels: dict[str, dict[((str, str), (str, str)), (str, str)]],
-           subnet: str):
+def generate_sub_graphs(services: dict[str, dict[str]], subnets: dict[str, dict[str, set]], task_subnets: list[str],
+                        service_ids: dict[str, int], exploitable_vulnerabilities: dict[str, dict[str, dict]],
+                        single_exploit: bool, single_label: bool, attack_states: list[(str, int)] = None,
+                        spill_path: str = None, spill_size: int = 0, bounds: AttackBounds = None) \
+        -> list[((np.ndarray, np.ndarray, str, np.ndarray), (int, int))]:
     """
-    Update attack_graph and graph_labels according to future results
+    Generate attack graphs of a task scheduled by AttackGraphLayer.
     Parameters:
-        attack_graph:
-        graph_labels:
-        subnet:
+        services:
+        subnets:
+        task_subnets: subnets of the task
+        service_ids:
+        exploitable_vulnerabilities:
+        single_exploit:
+        single_label:
+        attack_states: if not None, only expand these states of the only subnet in task_subnets
+        spill_path: directory to spill edges of the search to, see AttackEdgeSpill
+        spill_size: the most entries of the search kept in memory, 0 never spills to disk
+        bounds: if not None, bounds of the search, and attack_states should be None
     Returns:
-        a function with future as only parameter.
+        a list of edges, label offsets, labels and edge scores for each subnet, see pack_attack_edges(),
+        with the numbers of truncated attack states and edges
     """
-    def cbs(future: Future):
-        """
-        Concurrent callback functions for Future objects.
-        Parameter:
-            future: concurrent.futures.Future
-        
-        """
-        sub_graph, sub_labels = future.result()
-        attack_graph[subnet] = sub_graph
-        graph_labels[subnet] = sub_labels
-    return cbs
+    
+    if attack_states is not None:
+        return [(expand_attack_states(services, subnets, task_subnets[0], attack_states, service_ids,
+                                      exploitable_vulnerabilities, single_label, spill_path, spill_size), (0, 0))]
+    
+    results: list[((np.ndarray, np.ndarray, str, np.ndarray), (int, int))] = []
+    for subnet in task_subnets:
+        subnet_bounds = bounds.new_search() if bounds is not None else None
+        packed_edges = generate_sub_graph(services, subnets, subnet, service_ids, exploitable_vulnerabilities,
+                                          single_exploit, single_label, spill_path, spill_size, subnet_bounds)
+        truncation = (subnet_bounds.truncated_states, subnet_bounds.truncated_edges) \
+            if subnet_bounds is not None else (0, 0)
+        results.append((packed_edges, truncation))
+    
+    return results
 
 
 def generate_sub_graph(services: dict[str, dict[str]], subnets: dict[str, dict[str, set]], subnet: str,
-                       exploitable_vulnerabilities: dict[str, dict[str, dict]],
-                       single_exploit: bool, single_label: bool) \
-        -> (nx.DiGraph, dict[((str, str), (str, str)), str]):
+                       service_ids: dict[str, int], exploitable_vulnerabilities: dict[str, dict[str, dict]],
+                       single_exploit: bool, single_label: bool, spill_path: str = None, spill_size: int = 0,
+                       bounds: AttackBounds = None) -> (np.ndarray, np.ndarray, str, np.ndarray):
     """
     Generate attack graph for full connected subnets.
+    Results are packed into flat arrays, so that they are cheap to send back from worker processes.
     Parameters:
         services:
         subnets:
         subnet:
+        service_ids:
         exploitable_vulnerabilities:
         single_exploit:
         single_label:
+        spill_path: directory to spill edges of the search to, see AttackEdgeSpill
+        spill_size: the most entries of the search kept in memory, 0 never spills to disk
+        bounds: if not None, bounds of the search, where truncations are counted
     Returns:
-        a nx.Digraph object and its labels in dict
+        edges, label offsets, labels and edge scores, see pack_attack_edges()
     """
     
-    sub_graph = nx.DiGraph()
-    sub_labels: dict[((str, str), (str, str)), str] = dict()
-    
     gateways: set[str] = subnets[subnet]['gateways']
     neighbours: set[str] = subnets[subnet]['services']
     
-    exploited_vulnerabilities: dict[(str, str), set[str]] = dict()
-    
     if 'outside' in neighbours:
         gateways.add('outside')
     
-    for gateway in gateways:
+    with AttackEdgeSpill(spill_path, spill_size) as spill:
         
-        if gateway == 'outside':
-            gateway_post_privileges = {4: ['']}
-        else:
-            gateway_post_privileges: dict[int, list[str]] = exploitable_vulnerabilities[gateway]['post_values']
+        for gateway in gateways:
+            
+            if gateway == 'outside':
+                gateway_post_privileges = {4: ['']}
+            else:
+                gateway_post_privileges: dict[int, list[str]] = exploitable_vulnerabilities[gateway]['post_values']
+            
+            depth_stack = spill.depth_stack
+            exploited_services: set[str] = {gateway}
+            
+            for current_privilege in gateway_post_privileges:
+                depth_stack.append((gateway, current_privilege))
+                if bounds is not None:
+                    bounds.start((gateway, current_privilege))
+                
+            while len(depth_stack) > 0:
+                depth_first_search(exploited_services, spill.exploited_vulnerabilities, services, subnets, service_ids,
+                                   exploitable_vulnerabilities, spill.labels, depth_stack,
+                                   single_exploit, single_label, neighbours, bounds)
+        
+        print(f'Generated sub attack graph for subnet \'{subnet}\'', flush=True)
+        return spill.pack(exploitable_vulnerabilities, service_ids)
+
+
+def get_subnet_signature(subnets: dict[str, dict[str, set]], subnet: str,
+                         exploitable_vulnerabilities: dict[str, dict[str, dict]],
+                         single_exploit: bool, single_label: bool) -> str:
+    """
+    Get a canonical signature of everything the attack graph of a subnet depends on.
+    Exploitable vulnerabilities already reflect the images of members and the rule set.
+    Parameters:
+        subnets:
+        subnet:
+        exploitable_vulnerabilities:
+        single_exploit:
+        single_label:
+    Returns:
+        a hex digest of sha256
+    """
+    
+    gateways: set[str] = subnets[subnet]['gateways']
+    members = []
+    
+    for member in sorted(subnets[subnet]['services']):
+        
+        if member == 'outside':
+            members.append([member])
+            continue
+        
+        pre_values: dict[int, list[str]] = exploitable_vulnerabilities[member]['pre_values']
+        post_conditions: dict[str, int] = exploitable_vulnerabilities[member]['post_conditions']
+        scores: dict[str, float] = exploitable_vulnerabilities[member]['scores']
+        vulnerabilities = [[(vulnerability, post_conditions[vulnerability], scores[vulnerability])
+                            for vulnerability in pre_values[pre_condition]] for pre_condition in range(0, 5)]
+        members.append([member, member in gateways, vulnerabilities])
+    
+    # Graphs cached before edges were scored by the services they exploit have other scores, and are never loaded.
+    content = json.dumps(['scored-by-exploited-service', single_exploit, single_label, members], separators=(',', ':'))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def load_cached_sub_graph(cache_path: str, signature: str, service_ids: dict[str, int]) \
+        -> (np.ndarray, np.ndarray, str, np.ndarray):
+    """
+    Load an attack graph of a subnet from the cache, and mark it as recently used.
+    Parameters:
+        cache_path: directory of the cache
+        signature: signature of the subnet, see get_subnet_signature()
+        service_ids: integer ids of services
+    Returns:
+        edges, label offsets, labels and edge scores, see pack_attack_edges(), or None if it is not cached
+    """
+    
+    cache_file = os.path.join(cache_path, signature + '.npz')
+    
+    try:
+        with np.load(cache_file) as cached:
+            local_ids = np.array([service_ids[uid] for uid in cached['services'].tolist()], dtype=np.int32)
+            edges = cached['edges']
+            if edges.ndim != 2 or edges.shape[1] != 2:
+                raise ValueError(f'Attack graph {signature} is cached in another format.')
+            edges = local_ids[edges // 5] * 5 + edges % 5
+            packed_edges = (edges, cached['label_offsets'], str(cached['labels']), cached['edge_scores'])
+        os.utime(cache_file)
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    
+    return packed_edges
+
+
+def store_cached_sub_graph(cache_path: str, cache_size: int, signature: str,
+                           packed_edges: (np.ndarray, np.ndarray, str, np.ndarray), service_uids: list[str]):
+    """
+    Store an attack graph of a subnet to the cache, and remove the least recently used ones beyond cache_size.
+    Integer ids of services are not stable across runs, so services are stored by their uids.
+    Parameters:
+        cache_path: directory of the cache
+        cache_size: the most attack graphs kept in the cache
+        signature: signature of the subnet, see get_subnet_signature()
+        packed_edges: edges, label offsets, labels and edge scores, see pack_attack_edges()
+        service_uids: uids of services indexed by integer ids
+    """
+    
+    (edges, label_offsets, labels, edge_scores) = packed_edges
+    
+    ids, local_ids = np.unique(edges // 5, return_inverse=True)
+    local_edges = (local_ids.reshape(-1, 2) * 5 + edges % 5).astype(np.int32)
+    
+    os.makedirs(cache_path, exist_ok=True)
+    cache_file = os.path.join(cache_path, signature + '.npz')
+    
+    # Written to a temporary file first, so other runs never read a partial file.
+    temporary_file = os.path.join(cache_path, f'{signature}-{os.getpid()}.tmp.npz')
+    np.savez(temporary_file, services=np.array([service_uids[i] for i in ids.tolist()], dtype=str),
+             edges=local_edges, label_offsets=label_offsets, labels=np.array(labels), edge_scores=edge_scores)
+    os.replace(temporary_file, cache_file)
+    
+    cache_files = [os.path.join(cache_path, file) for file in os.listdir(cache_path)
+                   if file.endswith('.npz') and not file.endswith('.tmp.npz')]
+    if len(cache_files) > cache_size:
+        cache_files.sort(key=os.path.getmtime)
+        for file in cache_files[:len(cache_files) - cache_size]:
+            os.remove(file)
+
+
+def estimate_subnet_cost(subnets: dict[str, dict[str, set]], subnet: str,
+                         exploitable_vulnerabilities: dict[str, dict[str, dict]]) -> int:
+    """
+    Estimate the cost of generating the attack graph of a subnet, as members × gateways × CVE density,
+    where CVE density is the number of exploitable vulnerabilities per member.
+    Parameters:
+        subnets:
+        subnet:
+        exploitable_vulnerabilities:
+    Returns:
+        estimated cost in number of vulnerabilities checked
+    """
+    
+    members: set[str] = subnets[subnet]['services']
+    gateways: set[str] = subnets[subnet]['gateways']
+    
+    vulnerabilities = 0
+    for member in members:
+        if member != 'outside':
+            for pre_condition_vulnerabilities in exploitable_vulnerabilities[member]['pre_values'].values():
+                vulnerabilities += len(pre_condition_vulnerabilities)
+    
+    return len(gateways | ({'outside'} & members)) * vulnerabilities
+
+
+def get_next_privileges(exploitable: dict[str, dict], current_privilege: int, single_label: bool) -> dict[int, str]:
+    """
+    Get privileges of the attack states that depth_first_search() pushes after exploiting a service.
+    Parameters:
+        exploitable: exploitable vulnerabilities of the exploited service
+        current_privilege: privilege of the attacker
+        single_label:
+    Returns:
+        a dict of privileges, and the first vulnerability that pushes each of them
+    """
+    
+    pre_values: dict[int, list[str]] = exploitable['pre_values']
+    post_conditions: dict[str, int] = exploitable['post_conditions']
+    
+    next_privileges: dict[int, str] = dict()
+    post_privileges: set[int] = set()
+    
+    for pre_condition in range(0, current_privilege + 1):
+        for vulnerability in pre_values[pre_condition]:
+            
+            # With single labels, only the first vulnerability of an edge pushes a state.
+            if not single_label:
+                next_privileges.setdefault(pre_condition, vulnerability)
+            elif post_conditions[vulnerability] not in post_privileges:
+                post_privileges.add(post_conditions[vulnerability])
+                next_privileges.setdefault(pre_condition, vulnerability)
+    
+    return next_privileges
+
+
+def get_exposure_tables(exploitable: dict[str, dict], single_label: bool) -> (np.ndarray, np.ndarray):
+    """
+    Get how an attacker on a neighbour with each privilege can exploit a service.
+    Parameters:
+        exploitable: exploitable vulnerabilities of the service
+        single_label:
+    Returns:
+        the highest privilege of attack states pushed on the service, and the highest post-condition,
+        both as int8 arrays indexed by the privilege of the attacker, where -1 means none
+    """
+    
+    next_levels = np.full(5, -1, dtype=np.int8)
+    max_posts = np.full(5, -1, dtype=np.int8)
+    max_post = -1
+    
+    for current_privilege in range(0, 5):
         
-        depth_stack = deque()
-        exploited_services: set[str] = {gateway}
+        for vulnerability in exploitable['pre_values'][current_privilege]:
+            max_post = max(max_post, exploitable['post_conditions'][vulnerability])
+        max_posts[current_privilege] = max_post
         
-        for current_privilege in gateway_post_privileges:
-            depth_stack.append((gateway, current_privilege))
+        next_privileges = get_next_privileges(exploitable, current_privilege, single_label)
+        if len(next_privileges) > 0:
+            next_levels[current_privilege] = max(next_privileges)
+    
+    return next_levels, max_posts
+
+
+def get_attack_states(subnets: dict[str, dict[str, set]], subnet: str,
+                      exploitable_vulnerabilities: dict[str, dict[str, dict]], single_label: bool) \
+        -> list[(str, int)]:
+    """
+    Get all attack states that generate_sub_graph() expands in a subnet, without generating any edge.
+    Labels of an edge only depend on the state it starts from, so expanding each state once
+    gives the same attack graph, no matter how the states are split into tasks.
+    Parameters:
+        subnets:
+        subnet:
+        exploitable_vulnerabilities:
+        single_label:
+    Returns:
+        a sorted list of attack states, like [('service1', 0), ('service1', 4)]
+    """
+    
+    members: set[str] = subnets[subnet]['services']
+    attack_states: set[(str, int)] = set()
+    
+    for gateway in subnets[subnet]['gateways']:
+        if gateway != 'outside':
+            for privilege in exploitable_vulnerabilities[gateway]['post_values']:
+                attack_states.add((gateway, privilege))
+    
+    if 'outside' in members:
+        attack_states.add(('outside', VulnerabilityLayer.get_privilege_value('ADMIN')))
+    
+    # All members share the same neighbours, so successors of a state only depend on its privilege.
+    pending_privileges = {privilege for (_, privilege) in attack_states}
+    expanded_privileges = set(pending_privileges)
+    
+    while len(pending_privileges) > 0:
+        current_privilege = pending_privileges.pop()
+        for member in members:
             
-        while len(depth_stack) > 0:
-            depth_first_search(exploited_services, exploited_vulnerabilities, services, subnets,
-                               exploitable_vulnerabilities, sub_labels, depth_stack,
-                               single_exploit, single_label, neighbours)
+            if member == 'outside':
+                continue
+            
+            for privilege in get_next_privileges(exploitable_vulnerabilities[member], current_privilege, single_label):
+                attack_states.add((member, privilege))
+                if privilege not in expanded_privileges:
+                    expanded_privileges.add(privilege)
+                    pending_privileges.add(privilege)
+    
+    return sorted(attack_states)
+
+
+def expand_attack_states(services: dict[str, dict[str]], subnets: dict[str, dict[str, set]], subnet: str,
+                         attack_states: list[(str, int)], service_ids: dict[str, int],
+                         exploitable_vulnerabilities: dict[str, dict[str, dict]], single_label: bool,
+                         spill_path: str = None, spill_size: int = 0) -> (np.ndarray, np.ndarray, str, np.ndarray):
+    """
+    Generate the edges starting from a part of attack states of a subnet, see get_attack_states().
+    Parameters:
+        services:
+        subnets:
+        subnet:
+        attack_states:
+        service_ids:
+        exploitable_vulnerabilities:
+        single_label:
+        spill_path: directory to spill edges of the search to, see AttackEdgeSpill
+        spill_size: the most entries of the search kept in memory, 0 never spills to disk
+    Returns:
+        edges, label offsets, labels and edge scores, see pack_attack_edges()
+    """
+    
+    neighbours: set[str] = subnets[subnet]['services']
+    
+    with AttackEdgeSpill(spill_path, spill_size) as spill:
+        
+        for attack_state in attack_states:
+            
+            # States pushed by the search are expanded by their own tasks.
+            depth_stack = deque()
+            depth_stack.append(attack_state)
+            depth_first_search(set(), spill.exploited_vulnerabilities, services, subnets, service_ids,
+                               exploitable_vulnerabilities, spill.labels, depth_stack, False, single_label, neighbours)
+        
+        print(f'Expanded {len(attack_states)} attack states of subnet \'{subnet}\'', flush=True)
+        return spill.pack(exploitable_vulnerabilities, service_ids)
+
+
+def get_transfer_summary(subnets: dict[str, dict[str, set]], subnet: str,
+                         exploitable_vulnerabilities: dict[str, dict[str, dict]], single_label: bool) \
+        -> dict[int, (set[int], set[(str, int)])]:
+    """
+    Get how attack states entering a subnet spread through it, without generating any edge.
+    All members share the same neighbours, so it only depends on the privilege of the entry state,
+    not on which gateway the attacker enters from.
+    Parameters:
+        subnets:
+        subnet:
+        exploitable_vulnerabilities:
+        single_label:
+    Returns:
+        a dict of each entry privilege, to privileges of attack states reachable inside the subnet,
+        and attack states of gateways reachable inside the subnet, like {4: ({3, 4}, {('gateway1', 3)})}
+    """
+    
+    members = [member for member in subnets[subnet]['services'] if member != 'outside']
+    gateways = [gateway for gateway in subnets[subnet]['gateways'] if gateway != 'outside']
+    
+    next_privileges: dict[(str, int), dict[int, str]] = dict()
+    for member in members:
+        for current_privilege in range(0, 5):
+            next_privileges[(member, current_privilege)] = \
+                get_next_privileges(exploitable_vulnerabilities[member], current_privilege, single_label)
+    
+    transfer_summary: dict[int, (set[int], set[(str, int)])] = dict()
+    
+    for entry_privilege in range(0, 5):
+        
+        privileges = {entry_privilege}
+        pending_privileges = [entry_privilege]
+        while len(pending_privileges) > 0:
+            current_privilege = pending_privileges.pop()
+            for member in members:
+                for privilege in next_privileges[(member, current_privilege)]:
+                    if privilege not in privileges:
+                        privileges.add(privilege)
+                        pending_privileges.append(privilege)
+        
+        exits = {(gateway, privilege) for gateway in gateways for current_privilege in privileges
+                 for privilege in next_privileges[(gateway, current_privilege)]}
+        transfer_summary[entry_privilege] = (privileges, exits)
+    
+    return transfer_summary
+
+
+def generate_hierarchical_from_exposed(services: dict[str, dict[str]], subnets: dict[str, dict[str, set]],
+                                       service_ids: dict[str, int],
+                                       exploitable_vulnerabilities: dict[str, dict[str, dict]], single_label: bool,
+                                       spill_path: str = None, spill_size: int = 0) \
+        -> (np.ndarray, np.ndarray, str, np.ndarray):
+    """
+    Generate a full attack graph from exposed services, on the level of subnets and gateways.
+    Transfer summaries of subnets are solved on gateways first, then only reachable attack states are expanded,
+    each once in every subnet of its service. It gives the same graph as generate_full_from_exposed().
+    Parameters:
+        services:
+        subnets:
+        service_ids:
+        exploitable_vulnerabilities:
+        single_label:
+        spill_path: directory to spill edges of the search to, see AttackEdgeSpill
+        spill_size: the most entries of the search kept in memory, 0 never spills to disk
+    Returns:
+        packed edges, see pack_attack_edges()
+    """
+    
+    transfer_summaries = {subnet: get_transfer_summary(subnets, subnet, exploitable_vulnerabilities, single_label)
+                          for subnet in subnets}
     
-    sub_graph.add_edges_from([*sub_labels.keys()])
-    print(f'Generated sub attack graph for subnet \'{subnet}\'', flush=True)
-    return sub_graph, sub_labels
+    # Attack states entering each subnet, where gateways pass them to all of their subnets.
+    entry_states: dict[str, set[(str, int)]] = {subnet: set() for subnet in subnets}
+    entry_states['exposed'].add(('outside', VulnerabilityLayer.get_privilege_value('ADMIN')))
+    pending_entries = deque([('exposed', VulnerabilityLayer.get_privilege_value('ADMIN'))])
+    entry_privileges: dict[str, set[int]] = {subnet: set() for subnet in subnets}
+    entry_privileges['exposed'].add(VulnerabilityLayer.get_privilege_value('ADMIN'))
+    
+    while len(pending_entries) > 0:
+        subnet, entry_privilege = pending_entries.popleft()
+        for gateway_state in transfer_summaries[subnet][entry_privilege][1]:
+            for gateway_subnet in services[gateway_state[0]]['subnets']:
+                entry_states[gateway_subnet].add(gateway_state)
+                if gateway_state[1] not in entry_privileges[gateway_subnet]:
+                    entry_privileges[gateway_subnet].add(gateway_state[1])
+                    pending_entries.append((gateway_subnet, gateway_state[1]))
+    
+    packed_parts: list[(np.ndarray, np.ndarray, str, np.ndarray)] = []
+    
+    for subnet in subnets:
+        
+        if len(entry_privileges[subnet]) == 0:
+            continue
+        
+        privileges: set[int] = set()
+        for entry_privilege in entry_privileges[subnet]:
+            privileges |= transfer_summaries[subnet][entry_privilege][0]
+        
+        attack_states = set(entry_states[subnet])
+        for member in subnets[subnet]['services']:
+            if member != 'outside':
+                for current_privilege in privileges:
+                    for privilege in get_next_privileges(exploitable_vulnerabilities[member], current_privilege,
+                                                         single_label):
+                        attack_states.add((member, privilege))
+        
+        packed_parts.append(expand_attack_states(services, subnets, subnet, sorted(attack_states), service_ids,
+                                                 exploitable_vulnerabilities, single_label, spill_path, spill_size))
+    
+    if len(packed_parts) == 0:
+        return pack_attack_edges(dict(), exploitable_vulnerabilities, service_ids)
+    
+    # A state of a gateway has the same edges to services sharing its subnets, duplicates are merged by the store.
+    print('Generated full attack graph from outside.', flush=True)
+    return concatenate_attack_edges(packed_parts)
 
 
 def generate_full_from_exposed(services: dict[str, dict[str]], exploitable_vulnerabilities: dict[str, dict[str, dict]],
-                               subnets: dict[str, dict[str, set]], single_exploit: bool, single_label: bool) \
-        -> (nx.DiGraph, dict[((str, str), (str, str)), str]):
+                               subnets: dict[str, dict[str, set]], service_ids: dict[str, int], single_exploit: bool,
+                               single_label: bool, spill_path: str = None, spill_size: int = 0,
+                               bounds: AttackBounds = None) -> (np.ndarray, np.ndarray, str, np.ndarray):
     """
     Generate a full attack graph from exposed services.
     Parameters:
         services:
         exploitable_vulnerabilities:
         subnets:
+        service_ids:
         single_exploit:
         single_label:
+        spill_path: directory to spill edges of the search to, see AttackEdgeSpill
+        spill_size: the most entries of the search kept in memory, 0 never spills to disk
+        bounds: if not None, bounds of the search, where truncations are counted
     Returns:
-        a nx.Digraph object and its labels in dict
+        packed edges, see pack_attack_edges()
     """
     
-    composed_graph = nx.DiGraph()
-    composed_labels: dict[((str, str), (str, str)), str] = dict()
-    
-    exploited_vulnerabilities: dict[(str, str), set[str]] = dict()
-    depth_stack = deque()
-    depth_stack.append(('outside', VulnerabilityLayer.get_privilege_value('ADMIN')))
     exploited_services: set[str] = {'outside'}
-
-    while len(depth_stack) > 0:
-        depth_first_search(exploited_services, exploited_vulnerabilities, services, subnets,
-                           exploitable_vulnerabilities, composed_labels, depth_stack, single_exploit, single_label)
     
-    composed_graph.add_edges_from([*composed_labels.keys()])
-    print('Generated full attack graph from outside.', flush=True)
-    return composed_graph, composed_labels
+    with AttackEdgeSpill(spill_path, spill_size) as spill:
+        
+        depth_stack = spill.depth_stack
+        depth_stack.append(('outside', VulnerabilityLayer.get_privilege_value('ADMIN')))
+        while len(depth_stack) > 0:
+            depth_first_search(exploited_services, spill.exploited_vulnerabilities, services, subnets, service_ids,
+                               exploitable_vulnerabilities, spill.labels, depth_stack, single_exploit, single_label,
+                               bounds=bounds)
+        
+        print('Generated full attack graph from outside.', flush=True)
+        return spill.pack(exploitable_vulnerabilities, service_ids)
 
 
-def depth_first_search(exploited_services: set[str], exploited_vulnerabilities: dict[(str, str), set[str]],
+def depth_first_search(exploited_services: set[str], exploited_vulnerabilities: dict[(int, int), set[str]],
                        services: dict[str, dict[str]], subnets: dict[str, dict[str, set]],
-                       exploitable_vulnerabilities: dict[str, dict[str, dict]],
-                       sub_labels: dict[((str, str), (str, str)), str], depth_stack: deque,
-                       single_exploit: bool, single_label: bool, neighbours: set[str] = None):
+                       service_ids: dict[str, int], exploitable_vulnerabilities: dict[str, dict[str, dict]],
+                       sub_labels: dict[(int, int), str], depth_stack: deque,
+                       single_exploit: bool, single_label: bool, neighbours: set[str] = None,
+                       bounds: AttackBounds = None):
     """
-    Depth first search algorithm for generating graphs
+    Depth first search algorithm for generating graphs.
+    Attack vertices are encoded as service id * 5 + privilege, and only decoded by AttackGraphStore for display.
     Parameters:
         exploited_services:
         exploited_vulnerabilities:
         services:
         subnets:
+        service_ids:
         exploitable_vulnerabilities:
         sub_labels:
         depth_stack:
         single_exploit:
         single_label:
         neighbours:
+        bounds: if not None, the search is done by bounded_depth_first_search()
     """
     
+    if bounds is not None:
+        bounded_depth_first_search(exploited_services, exploited_vulnerabilities, services, subnets, service_ids,
+                                   exploitable_vulnerabilities, sub_labels, depth_stack, single_exploit, single_label,
+                                   neighbours, bounds)
+        return
+    
     (exploited_service, current_privilege) = depth_stack.pop()
+    start_attack_vertex = service_ids[exploited_service] * 5 + current_privilege
     
     if neighbours is None:
         neighbours = TopologyLayer.get_neighbours(services, subnets, exploited_service)
@@ -273,13 +1237,12 @@ def depth_first_search(exploited_services: set[str], exploited_vulnerabilities:
         
         neighbour_exploitable = exploitable_vulnerabilities[neighbour]['pre_values']
         neighbour_post = exploitable_vulnerabilities[neighbour]['post_conditions']
+        neighbour_vertex = service_ids[neighbour] * 5
         
         for neighbour_pre_condition in range(0, current_privilege + 1):
             for vulnerability in neighbour_exploitable[neighbour_pre_condition]:
                 
-                neighbour_post_condition = neighbour_post[vulnerability]
-                start_attack_vertex = (exploited_service, VulnerabilityLayer.get_privilege_str(current_privilege))
-                end_attack_vertex = (neighbour, VulnerabilityLayer.get_privilege_str(neighbour_post_condition))
+                end_attack_vertex = neighbour_vertex + neighbour_post[vulnerability]
                 
                 if single_exploit:
                     if neighbour not in exploited_services:
@@ -301,8 +1264,80 @@ def depth_first_search(exploited_services: set[str], exploited_vulnerabilities:
                         depth_stack.append((neighbour, neighbour_pre_condition))
 
 
-def add_attack_edge(sub_labels: dict[((str, str), (str, str)), str], start_attack_vertex: (str, str),
-                    end_attack_vertex: (str, str), vulnerability: str):
+def bounded_depth_first_search(exploited_services: set[str], exploited_vulnerabilities: dict[(int, int), set[str]],
+                               services: dict[str, dict[str]], subnets: dict[str, dict[str, set]],
+                               service_ids: dict[str, int], exploitable_vulnerabilities: dict[str, dict[str, dict]],
+                               sub_labels: dict[(int, int), str], depth_stack: deque,
+                               single_exploit: bool, single_label: bool, neighbours: set[str], bounds: AttackBounds):
+    """
+    Depth first search like depth_first_search(), within a maximum depth, an edge budget,
+    and a beam of exploits with the highest CVSS scores from each attack state.
+    Parameters:
+        exploited_services:
+        exploited_vulnerabilities:
+        services:
+        subnets:
+        service_ids:
+        exploitable_vulnerabilities:
+        sub_labels:
+        depth_stack:
+        single_exploit:
+        single_label:
+        neighbours:
+        bounds: bounds of the search, where truncations are counted
+    """
+    
+    attack_state = depth_stack.pop()
+    if not bounds.expand(attack_state):
+        return
+    
+    (exploited_service, current_privilege) = attack_state
+    start_attack_vertex = service_ids[exploited_service] * 5 + current_privilege
+    
+    if neighbours is None:
+        neighbours = TopologyLayer.get_neighbours(services, subnets, exploited_service)
+    
+    # Exploits are ranked by scores on the images of neighbours, as edges are scored where they are generated.
+    exploits: list[(str, int, str, int, float)] = []
+    for neighbour in neighbours:
+        if neighbour != 'outside':
+            neighbour_exploitable = exploitable_vulnerabilities[neighbour]['pre_values']
+            neighbour_post = exploitable_vulnerabilities[neighbour]['post_conditions']
+            neighbour_scores = exploitable_vulnerabilities[neighbour]['scores']
+            for neighbour_pre_condition in range(0, current_privilege + 1):
+                for vulnerability in neighbour_exploitable[neighbour_pre_condition]:
+                    exploits.append((neighbour, neighbour_pre_condition, vulnerability,
+                                     service_ids[neighbour] * 5 + neighbour_post[vulnerability],
+                                     neighbour_scores.get(vulnerability, 0)))
+    
+    for (neighbour, neighbour_pre_condition, vulnerability, end_attack_vertex, _) \
+            in bounds.select(start_attack_vertex, exploits):
+        
+        label = (start_attack_vertex, end_attack_vertex)
+        
+        if single_exploit:
+            if neighbour not in exploited_services and (label in sub_labels or bounds.add_edge(label)):
+                exploited_services.add(neighbour)
+                add_attack_edge(sub_labels, start_attack_vertex, end_attack_vertex, vulnerability)
+                bounds.push(attack_state, (neighbour, neighbour_pre_condition))
+                depth_stack.append((neighbour, neighbour_pre_condition))
+        
+        elif label not in sub_labels:
+            if bounds.add_edge(label):
+                exploited_vulnerabilities[label] = {vulnerability}
+                add_attack_edge(sub_labels, start_attack_vertex, end_attack_vertex, vulnerability)
+                bounds.push(attack_state, (neighbour, neighbour_pre_condition))
+                depth_stack.append((neighbour, neighbour_pre_condition))
+        
+        elif not single_label and vulnerability not in exploited_vulnerabilities[label]:
+            exploited_vulnerabilities[label].add(vulnerability)
+            add_attack_edge(sub_labels, start_attack_vertex, end_attack_vertex, vulnerability)
+            bounds.push(attack_state, (neighbour, neighbour_pre_condition))
+            depth_stack.append((neighbour, neighbour_pre_condition))
+
+
+def add_attack_edge(sub_labels: dict[(int, int), str], start_attack_vertex: int, end_attack_vertex: int,
+                    vulnerability: str):
     """
     Add an edge to the attack graph
     Parameters:
@@ -0,0 +1,371 @@
+#  Copyright 2022 Hanwen Zhang
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  Unless required by applicable law or agreed to in writing, software.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Array-backed storage of attack graphs.
+Including class AttackGraphStore
+"""
+
+import copy
+import itertools
+import numpy as np
+import networkx as nx
+
+from layers.vulnerability_layer import VulnerabilityLayer
+
+# Versions are unique across all stores, so that a replaced store is never taken as an unchanged one.
+_versions = itertools.count(1)
+
+
+class AttackGraphStore:
+    """
+    Attack graph stored in integer edge arrays, where an attack vertex is encoded as service id * 5 + privilege.
+    Edges are appended in COO chunks, and frozen on the first read,
+    with duplicates removed and a CSR index of edges by their start vertices.
+    Frozen edges keep the order they are added, which is the order networkx graphs and labels are built in.
+    Properties:
+        service_uids: uids of services indexed by integer ids, shared with TopologyLayer
+        
+        edges: int32 array in shape of (n, 2), columns are encoded start and end vertices
+        
+        label_offsets: int64 array of n + 1 offsets, the label of edge i is labels[label_offsets[i]:label_offsets[i+1]]
+        
+        labels: all labels concatenated
+        
+        scores: float64 array of n, the highest CVSS score of vulnerabilities of each edge
+        
+        vertices: sorted int64 array of encoded attack vertices
+        
+        graph: a nx.DiGraph view of the attack graph, built on the first access
+        
+        graph_labels: a dict view of labels, like {(('outside', 'ADMIN'), ('service1', 'USER')): 'CVE-2022-0001'}
+        
+        version: a number changed whenever edges or vertices are changed
+    """
+    
+    def __init__(self, service_uids: list[str]):
+        """
+        Initialise an empty attack graph store
+        Parameters:
+            service_uids: uids of services indexed by integer ids
+        """
+        
+        self._service_uids = service_uids
+        self._chunks: list[(np.ndarray, np.ndarray, str, np.ndarray)] = []
+        
+        self._edges = np.zeros((0, 2), dtype=np.int32)
+        self._label_offsets = np.zeros(1, dtype=np.int64)
+        self._labels = ''
+        self._scores = np.zeros(0, dtype=np.float64)
+        self._vertices = np.zeros(0, dtype=np.int64)
+        self._edge_order = None
+        self._edge_index = None
+        
+        self._graph = None
+        self._graph_labels = None
+        self._version = next(_versions)
+    
+    @property
+    def service_uids(self) -> list[str]:
+        """
+        Returns:
+            uids of services indexed by integer ids
+        """
+        return self._service_uids
+    
+    @property
+    def edges(self) -> np.ndarray:
+        """
+        Returns:
+            int32 array in shape of (n, 2), columns are encoded start and end vertices
+        """
+        self.freeze()
+        return self._edges
+    
+    @property
+    def label_offsets(self) -> np.ndarray:
+        """
+        Returns:
+            int64 array of n + 1 offsets, the label of edge i is labels[label_offsets[i]:label_offsets[i+1]]
+        """
+        self.freeze()
+        return self._label_offsets
+    
+    @property
+    def labels(self) -> str:
+        """
+        Returns:
+            all labels concatenated
+        """
+        self.freeze()
+        return self._labels
+    
+    @property
+    def scores(self) -> np.ndarray:
+        """
+        Returns:
+            float64 array of n, the highest CVSS score of vulnerabilities of each edge
+        """
+        self.freeze()
+        return self._scores
+    
+    @property
+    def vertices(self) -> np.ndarray:
+        """
+        Returns:
+            sorted int64 array of encoded attack vertices
+        """
+        self.freeze()
+        return self._vertices
+    
+    @property
+    def graph(self) -> nx.DiGraph:
+        """
+        Returns:
+            a nx.DiGraph view of the attack graph, built on the first access
+        """
+        if self._graph is None:
+            self._graph = nx.DiGraph()
+            self._graph.add_edges_from([*self.graph_labels.keys()])
+            self._graph.add_nodes_from([self.decode_vertex(vertex) for vertex in self.vertices.tolist()])
+        return self._graph
+    
+    @property
+    def graph_labels(self) -> dict[((str, str), (str, str)), str]:
+        """
+        Returns:
+            a dict view of labels, like {(('outside', 'ADMIN'), ('service1', 'USER')): 'CVE-2022-0001'}
+        """
+        if self._graph_labels is None:
+            offsets = self.label_offsets.tolist()
+            attack_vertices = {vertex: self.decode_vertex(vertex) for vertex in self.vertices.tolist()}
+            self._graph_labels = dict()
+            for i, (start_vertex, end_vertex) in enumerate(self.edges.tolist()):
+                label = (attack_vertices[start_vertex], attack_vertices[end_vertex])
+                self._graph_labels[label] = self._labels[offsets[i]:offsets[i + 1]]
+        return self._graph_labels
+    
+    @property
+    def version(self) -> int:
+        """
+        Returns:
+            a number changed whenever edges or vertices are changed
+        """
+        return self._version
+    
+    def add_edges(self, edges: np.ndarray, label_offsets: np.ndarray, labels: str, scores: np.ndarray):
+        """
+        Append a COO chunk of edges, see pack_attack_edges()
+        Parameters:
+            edges:
+            label_offsets:
+            labels:
+            scores:
+        """
+        
+        if len(edges) > 0:
+            self._chunks.append((edges, label_offsets, labels, scores))
+            self.__invalidate()
+    
+    def fork(self, service_uids: list[str]) -> 'AttackGraphStore':
+        """
+        Fork the store, sharing its arrays, which are never changed in place but replaced, see freeze()
+        Parameters:
+            service_uids: uids of services of the fork, starting with the uids of this store
+        Returns:
+            a store with the same edges and version, changed apart from this store
+        """
+        
+        fork = copy.copy(self)
+        fork._service_uids = service_uids
+        fork._chunks = list(self._chunks)
+        return fork
+    
+    def freeze(self):
+        """
+        Concatenate appended chunks to frozen edges, remove duplicated edges, and index edges by start vertices.
+        The first label of a duplicated edge is kept.
+        """
+        
+        if len(self._chunks) == 0 and self._edge_index is not None:
+            return
+        
+        edge_parts = [self._edges] + [edges for (edges, _, _, _) in self._chunks]
+        offset_parts = [self._label_offsets[1:]]
+        start = len(self._labels)
+        for (_, label_offsets, labels, _) in self._chunks:
+            offset_parts.append(label_offsets[1:] + start)
+            start += len(labels)
+        
+        edges = np.concatenate(edge_parts).astype(np.int32, copy=False).reshape(-1, 2)
+        ends = np.concatenate(offset_parts)
+        label_starts = np.concatenate([np.zeros(1, dtype=np.int64), ends[:-1]])
+        labels = ''.join([self._labels] + [labels for (_, _, labels, _) in self._chunks])
+        scores = np.concatenate([self._scores] + [scores for (_, _, _, scores) in self._chunks]).astype(np.float64)
+        self._chunks = []
+        
+        vertex_count = len(self.service_uids) * 5
+        keys = edges[:, 0].astype(np.int64) * vertex_count + edges[:, 1]
+        _, first_indices = np.unique(keys, return_index=True)
+        
+        if len(first_indices) < len(edges):
+            kept = np.sort(first_indices)
+            edges = edges[kept]
+            scores = scores[kept]
+            kept_labels = [labels[label_starts[i]:ends[i]] for i in kept.tolist()]
+            labels = ''.join(kept_labels)
+            ends = np.cumsum(np.fromiter(map(len, kept_labels), dtype=np.int64, count=len(kept_labels)))
+        
+        self._edges = edges
+        self._label_offsets = np.concatenate([np.zeros(1, dtype=np.int64), ends]).astype(np.int64)
+        self._labels = labels
+        self._scores = scores
+        self._vertices = np.union1d(self._vertices, edges.ravel().astype(np.int64))
+        
+        self._edge_order = np.argsort(edges[:, 0], kind='stable')
+        self._edge_index = np.zeros(vertex_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edges[:, 0], minlength=vertex_count), out=self._edge_index[1:])
+    
+    def remove_edges(self, mask: np.ndarray):
+        """
+        Remove frozen edges, while their vertices are kept
+        Parameters:
+            mask: bool array over edges, where True means to remove
+        """
+        
+        self.freeze()
+        if not mask.any():
+            return
+        
+        (self._edges, self._label_offsets, self._labels, self._scores) = self.select_edges(~mask)
+        self.__invalidate()
+    
+    def select_edges(self, mask: np.ndarray) -> (np.ndarray, np.ndarray, str, np.ndarray):
+        """
+        Pack a subset of frozen edges, see pack_attack_edges()
+        Parameters:
+            mask: bool array over edges, where True means to select
+        Returns:
+            edges, label offsets, labels and scores in order they are added
+        """
+        
+        selected = np.flatnonzero(mask)
+        offsets = self.label_offsets.tolist()
+        selected_labels = [self._labels[offsets[i]:offsets[i + 1]] for i in selected.tolist()]
+        
+        label_offsets = np.zeros(len(selected) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, selected_labels), dtype=np.int64, count=len(selected_labels)),
+                  out=label_offsets[1:])
+        return self._edges[selected], label_offsets, ''.join(selected_labels), self._scores[selected]
+    
+    def remove_vertices(self, vertices: np.ndarray):
+        """
+        Remove vertices with all their edges
+        Parameters:
+            vertices: encoded attack vertices
+        """
+        
+        self.remove_edges(np.isin(self.edges, vertices).any(axis=1))
+        self._vertices = np.setdiff1d(self._vertices, vertices)
+        self.__invalidate()
+    
+    def get_out_edges(self, vertex: int) -> np.ndarray:
+        """
+        Get indices of frozen edges starting from a vertex, with the CSR index
+        Parameters:
+            vertex: encoded attack vertex
+        Returns:
+            int64 array of edge indices in order they are added
+        """
+        self.freeze()
+        if vertex >= len(self._edge_index) - 1:
+            return np.zeros(0, dtype=np.int64)
+        return self._edge_order[self._edge_index[vertex]:self._edge_index[vertex + 1]]
+    
+    def get_degrees(self) -> (np.ndarray, np.ndarray):
+        """
+        Returns:
+            in-degrees and out-degrees of all encoded attack vertices, as int64 arrays indexed by vertices
+        """
+        vertex_count = len(self.service_uids) * 5
+        return np.bincount(self.edges[:, 1], minlength=vertex_count), np.diff(self._edge_index)
+    
+    def get_reachable(self, sources: np.ndarray) -> np.ndarray:
+        """
+        Find vertices reachable from sources, by one breadth first sweep over the CSR index
+        Parameters:
+            sources: encoded attack vertices to start from
+        Returns:
+            bool array indexed by encoded attack vertices, True if reachable
+        """
+        
+        self.freeze()
+        reachable = np.zeros(len(self._edge_index) - 1, dtype=bool)
+        frontier = np.unique(sources[sources < len(reachable)])
+        reachable[frontier] = True
+        
+        while len(frontier) > 0:
+            starts = self._edge_index[frontier]
+            lengths = self._edge_index[frontier + 1] - starts
+            
+            # Indices of out edges of all vertices in the frontier, gathered from their ranges in the CSR index.
+            range_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+            out_edges = self._edge_order[range_starts + np.arange(lengths.sum())]
+            
+            end_vertices = self._edges[out_edges, 1]
+            frontier = np.unique(end_vertices[~reachable[end_vertices]])
+            reachable[frontier] = True
+        
+        return reachable
+    
+    def number_of_edges(self) -> int:
+        """
+        Returns:
+            the number of frozen edges
+        """
+        return len(self.edges)
+    
+    def number_of_vertices(self) -> int:
+        """
+        Returns:
+            the number of attack vertices
+        """
+        return len(self.vertices)
+    
+    def decode_vertex(self, vertex: int) -> (str, str):
+        """
+        Decode an attack vertex to its service and privilege
+        Parameters:
+            vertex: encoded attack vertex
+        Returns:
+            attack vertex like ('service1', 'USER')
+        """
+        return self.service_uids[vertex // 5], VulnerabilityLayer.get_privilege_str(vertex % 5)
+    
+    def get_edge_keys(self) -> np.ndarray:
+        """
+        Returns:
+            int64 keys of frozen edges, start vertex << 32 | end vertex, which never change as services are added
+        """
+        edges = self.edges.astype(np.int64)
+        return (edges[:, 0] << 32) | edges[:, 1]
+    
+    def __invalidate(self):
+        """
+        Drop the CSR index and views, and take a new version, after edges are changed
+        """
+        self._version = next(_versions)
+        self._edge_order = None
+        self._edge_index = None
+        self._graph = None
+        self._graph_labels = None
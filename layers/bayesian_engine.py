@@ -0,0 +1,411 @@
+#  Copyright 2022 Hanwen Zhang
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  Unless required by applicable law or agreed to in writing, software.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Bayesian probabilities of services over merged graphs, with sparse matrices.
+Including class SparseBayesianEngine
+"""
+
+import copy
+import math
+import statistics
+from collections import deque
+from concurrent.futures import Executor
+import scipy.sparse as sp
+import numpy as np
+
+from layers.topology_layer import TopologyLayer
+
+
+class SparseBayesianEngine:
+    """
+    Engine propagating bayesian probabilities from a service in breadth first order over a merged graph,
+    where the merged graph is a CSR matrix of edge probabilities indexed by integer ids of services.
+    Properties:
+        topology_layer: TopologyLayer binding, for neighbours, gateways and integer ids of services
+        
+        probability_matrix: scipy.sparse CSR matrix, where entry (i, j) is the probability of the merged edge i -> j
+    """
+    
+    def __init__(self, topology_layer: TopologyLayer, merged_labels: dict[(str, str), dict[str]]):
+        """
+        Parameters:
+            topology_layer: TopologyLayer to bind with
+            merged_labels: labels of a merged graph, with probabilities
+        """
+        
+        self._topology_layer = topology_layer
+        self._probability_matrix = self.__build_matrix(merged_labels)
+        
+        # What each service in the search did in the last refresh, as rows of merged neighbours it summed up,
+        # and neighbours it set, and rows of the matrix changed since then.
+        self._from_n = None
+        self._propagations: dict[str, (list[int], list[str])] = dict()
+        self._changed_rows: set[int] = set()
+    
+    @property
+    def topology_layer(self) -> TopologyLayer:
+        """
+        Returns:
+            topology_layer: TopologyLayer binding, for neighbours, gateways and integer ids of services
+        """
+        return self._topology_layer
+    
+    @property
+    def probability_matrix(self) -> sp.csr_matrix:
+        """
+        Returns:
+            probability_matrix: scipy.sparse CSR matrix, where entry (i, j) is the probability of the merged edge i -> j
+        """
+        return self._probability_matrix
+    
+    def fork(self, topology_layer: TopologyLayer) -> 'SparseBayesianEngine':
+        """
+        Fork the engine, sharing its matrix and what the last refresh did, which are replaced rather than changed
+        Parameters:
+            topology_layer: TopologyLayer of the fork
+        Returns:
+            an engine refreshed apart from this engine
+        """
+        
+        fork = copy.copy(self)
+        fork._topology_layer = topology_layer
+        fork._changed_rows = set(self._changed_rows)
+        return fork
+    
+    def get_probabilities(self, merged_services: set[str], from_n: str = 'outside') -> dict[str, float]:
+        """
+        Get bayesian probabilities for all services presenting in subnets, searching from gateways in breadth first
+        Parameters:
+            merged_services: services in the merged graph
+            from_n: where search starts
+        Returns:
+            a dict of services and their probabilities
+        """
+        
+        service_probabilities: dict[str, float] = dict()
+        self._propagations = dict()
+        self.refresh_probabilities(service_probabilities, merged_services, from_n)
+        return service_probabilities
+    
+    def update_labels(self, merged_labels: dict[(str, str), dict[str]]):
+        """
+        Rebuild the matrix from new labels of the merged graph, and keep which rows are changed
+        Parameters:
+            merged_labels: labels of a merged graph, with probabilities
+        """
+        
+        probability_matrix = self.__build_matrix(merged_labels)
+        old_matrix = self.probability_matrix.copy()
+        old_matrix.resize(probability_matrix.shape)
+        
+        self._changed_rows.update((probability_matrix != old_matrix).nonzero()[0].tolist())
+        self._probability_matrix = probability_matrix
+    
+    def refresh_probabilities(self, service_probabilities: dict[str, float], merged_services: set[str],
+                              from_n: str = 'outside') -> set[str]:
+        """
+        Patch bayesian probabilities in place, after labels or the topology are changed.
+        The breadth first search is repeated, but a service only recomputes probabilities of the neighbours it sets,
+        if they, its merged neighbours, their rows of the matrix, or its own probability are changed.
+        Parameters:
+            service_probabilities: probabilities of the last refresh, or an empty dict
+            merged_services: services in the merged graph
+            from_n: where search starts
+        Returns:
+            services whose probabilities are changed
+        """
+        
+        if from_n not in merged_services:
+            raise ValueError(f'service \'{from_n}\' undefined in merged graph.')
+        
+        if from_n != self._from_n:
+            self._from_n = from_n
+            self._propagations = dict()
+            service_probabilities.clear()
+        
+        topology_layer = self.topology_layer
+        service_ids = topology_layer.service_ids
+        changed_services: set[str] = set()
+        
+        if service_probabilities.get(from_n) != 1:
+            service_probabilities[from_n] = 1
+            changed_services.add(from_n)
+        
+        visited = {from_n}
+        propagations: dict[str, (list[int], list[str])] = dict()
+        queue = deque()
+        queue.append(from_n)
+        
+        while len(queue) > 0:
+            
+            has_bayesian = queue.popleft()
+            neighbours = topology_layer.get_neighbours(topology_layer.services, topology_layer.subnets, has_bayesian)
+            
+            row = service_ids[has_bayesian]
+            neighbour_rows: list[int] = list()
+            children: list[str] = list()
+            for neighbour in neighbours:
+                
+                if neighbour not in merged_services:
+                    continue
+                
+                neighbour_rows.append(service_ids[neighbour])
+                if neighbour in visited:
+                    continue
+                
+                if neighbour in topology_layer.gateway_services:
+                    queue.append(neighbour)
+                
+                visited.add(neighbour)
+                children.append(neighbour)
+            
+            propagations[has_bayesian] = (neighbour_rows, children)
+            if self._propagations.get(has_bayesian) == propagations[has_bayesian] \
+                    and has_bayesian not in changed_services \
+                    and row not in self._changed_rows and self._changed_rows.isdisjoint(neighbour_rows):
+                continue
+            
+            # Rows of the service and its neighbours, in the order the terms are summed up,
+            # so that probabilities are rounded the same as summing them up one by one.
+            coefficients = np.concatenate([[service_probabilities[has_bayesian]],
+                                           self.probability_matrix[row, neighbour_rows].toarray().ravel()])
+            probabilities = self.probability_matrix[[row] + neighbour_rows].T @ coefficients
+            
+            for neighbour in children:
+                probability = float(probabilities[service_ids[neighbour]]) if 'honey' not in neighbour else 0
+                if service_probabilities.get(neighbour) != probability:
+                    service_probabilities[neighbour] = probability
+                    changed_services.add(neighbour)
+        
+        # Services no longer reached are dropped.
+        for service in [*service_probabilities.keys()]:
+            if service not in visited:
+                del service_probabilities[service]
+                changed_services.add(service)
+        
+        self._propagations = propagations
+        self._changed_rows = set()
+        return changed_services
+    
+    def get_probability_table(self, merged_services: set[str], sources: list[str], targets: list[str]) -> np.ndarray:
+        """
+        Get bayesian probabilities from many sources to many targets in one pass.
+        Breadth first searches only decide which service sets the probability of each other, per source.
+        Then probabilities of all sources are propagated together, as a dense matrix of services × sources,
+        level by level, with one-hop terms and two-hop terms from a sparse product shared by all sources.
+        Probabilities are the same as get_probabilities() from each source, up to the rounding of sums.
+        Parameters:
+            merged_services: services in the merged graph
+            sources: services where searches start
+            targets: services to get probabilities of
+        Returns:
+            float64 array of sources × targets, where unreachable targets have probability 0
+        """
+        
+        service_ids = self.topology_layer.service_ids
+        
+        parent_rows: list[int] = list()
+        target_rows: list[int] = list()
+        columns: list[int] = list()
+        depths: list[int] = list()
+        honeypots: list[bool] = list()
+        
+        for column, source in enumerate(sources):
+            
+            if source not in merged_services:
+                raise ValueError(f'service \'{source}\' undefined in merged graph.')
+            
+            service_depths = {source: 0}
+            for (has_bayesian, neighbour) in self.__search(merged_services, source):
+                service_depths[neighbour] = service_depths[has_bayesian] + 1
+                parent_rows.append(service_ids[has_bayesian])
+                target_rows.append(service_ids[neighbour])
+                columns.append(column)
+                depths.append(service_depths[neighbour])
+                honeypots.append('honey' in neighbour)
+        
+        parent_rows = np.array(parent_rows, dtype=np.int64)
+        target_rows = np.array(target_rows, dtype=np.int64)
+        columns = np.array(columns, dtype=np.int64)
+        depths = np.array(depths, dtype=np.int64)
+        honeypots = np.array(honeypots, dtype=bool)
+        
+        # Two-hop terms only depend on the parent, so they are shared by all sources.
+        (parents, parent_indices) = np.unique(parent_rows, return_inverse=True)
+        two_hop_matrix = (self.probability_matrix[parents] @ self.probability_matrix).tocsr()
+        one_hops = np.asarray(self.probability_matrix[parent_rows, target_rows]).ravel()
+        two_hops = np.asarray(two_hop_matrix[parent_indices, target_rows]).ravel()
+        one_hops[honeypots] = 0
+        two_hops[honeypots] = 0
+        
+        probabilities = np.zeros((len(self.topology_layer.service_uids), len(sources)), dtype=np.float64)
+        probabilities[[service_ids[source] for source in sources], np.arange(len(sources))] = 1
+        
+        for depth in range(1, depths.max(initial=0) + 1):
+            level = np.flatnonzero(depths == depth)
+            probabilities[target_rows[level], columns[level]] = \
+                probabilities[parent_rows[level], columns[level]] * one_hops[level] + two_hops[level]
+        
+        return probabilities[[service_ids[target] for target in targets]].T
+    
+    def estimate_probabilities(self, merged_services: set[str], from_n: str = 'outside', samples: int = 10000,
+                               confidence: float = 0.95, executor: Executor = None, workers: int = 1,
+                               seed: int = None) -> dict[str, (float, float, float)]:
+        """
+        Estimate probabilities that services are compromised, over all attack paths rather than two hops,
+        by sampling realisations of the merged graph, where each edge succeeds by its probability independently.
+        Samples are split into tasks of the executor, each with its own random stream, see sample_compromises().
+        Parameters:
+            merged_services: services in the merged graph
+            from_n: where attacks start
+            samples: the number of realisations, rounded up to a multiple of 64
+            confidence: confidence level of intervals
+            executor: concurrent.futures.Executor or None
+            workers: the number of tasks to split samples into, when executor is not None
+            seed: seed of random streams, or None for a random seed
+        Returns:
+            a dict of services, and their estimated probabilities with lower and upper bounds of the Wilson intervals
+        """
+        
+        if from_n not in merged_services:
+            raise ValueError(f'service \'{from_n}\' undefined in merged graph.')
+        
+        service_ids = self.topology_layer.service_ids
+        matrix = self.probability_matrix.tocoo()
+        words = max(1, math.ceil(samples / 64))
+        tasks = max(1, min(words, workers if executor is not None else 1))
+        seeds = np.random.SeedSequence(seed).spawn(tasks)
+        
+        task_arguments = [(matrix.row, matrix.col, matrix.data, matrix.shape[0], [service_ids[from_n]],
+                           (words // tasks + (task < words % tasks)) * 64, seeds[task]) for task in range(tasks)]
+        if executor is None:
+            counts = [sample_compromises(*arguments) for arguments in task_arguments]
+        else:
+            futures = [executor.submit(sample_compromises, *arguments) for arguments in task_arguments]
+            counts = [future.result() for future in futures]
+        
+        compromises = np.sum(counts, axis=0)
+        n = words * 64
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        
+        estimates: dict[str, (float, float, float)] = dict()
+        for service in sorted(merged_services, key=service_ids.get):
+            
+            # Wilson score interval, which stays within [0, 1] even for probabilities close to 0 or 1.
+            p = compromises[service_ids[service]] / n
+            centre = (p + z * z / (2 * n)) / (1 + z * z / n)
+            margin = z / (1 + z * z / n) * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+            estimates[service] = (float(p), max(0.0, float(centre - margin)), min(1.0, float(centre + margin)))
+        
+        return estimates
+    
+    def __search(self, merged_services: set[str], from_n: str):
+        """
+        Breadth first search of get_probabilities(), without computing probabilities
+        Parameters:
+            merged_services: services in the merged graph
+            from_n: where search starts
+        Returns:
+            a generator of each service, and the neighbour whose probability it sets, in order they are set
+        """
+        
+        topology_layer = self.topology_layer
+        visited = {from_n}
+        queue = deque()
+        queue.append(from_n)
+        
+        while len(queue) > 0:
+            has_bayesian = queue.popleft()
+            for neighbour in topology_layer.get_neighbours(topology_layer.services, topology_layer.subnets,
+                                                           has_bayesian):
+                
+                if neighbour not in merged_services or neighbour in visited:
+                    continue
+                
+                if neighbour in topology_layer.gateway_services:
+                    queue.append(neighbour)
+                
+                visited.add(neighbour)
+                yield has_bayesian, neighbour
+    
+    def __build_matrix(self, merged_labels: dict[(str, str), dict[str]]) -> sp.csr_matrix:
+        """
+        Build the CSR matrix of edge probabilities
+        Parameters:
+            merged_labels: labels of a merged graph, with probabilities
+        Returns:
+            scipy.sparse CSR matrix, where entry (i, j) is the probability of the merged edge i -> j
+        """
+        
+        service_ids = self.topology_layer.service_ids
+        vertex_count = len(self.topology_layer.service_uids)
+        rows = np.fromiter((service_ids[start_service] for (start_service, _) in merged_labels), dtype=np.int64,
+                           count=len(merged_labels))
+        columns = np.fromiter((service_ids[service] for (_, service) in merged_labels), dtype=np.int64,
+                              count=len(merged_labels))
+        probabilities = np.fromiter((label['probability'] for label in merged_labels.values()), dtype=np.float64,
+                                    count=len(merged_labels))
+        
+        return sp.csr_matrix((probabilities, (rows, columns)), shape=(vertex_count, vertex_count))
+
+
+def sample_compromises(rows: np.ndarray, columns: np.ndarray, probabilities: np.ndarray, vertex_count: int,
+                       sources: list[int], samples: int, seed: np.random.SeedSequence) -> np.ndarray:
+    """
+    Count how many random realisations of a merged graph each service is reachable in, from sources.
+    Realisations are packed as bits, 64 of them in each word, so that one realisation of all edges
+    is a boolean matrix of edges × words, and reachability of all of them is propagated at once,
+    by OR-reducing edges grouped by their end services, until no service is newly reached.
+    Parameters:
+        rows: integer ids of start services of edges
+        columns: integer ids of end services of edges
+        probabilities: probabilities of edges to succeed
+        vertex_count: the number of integer ids of services
+        sources: integer ids of services where attacks start
+        samples: the number of realisations, a multiple of 64
+        seed: seed of the random stream
+    Returns:
+        int64 array of counts indexed by integer ids of services
+    """
+    
+    rng = np.random.default_rng(seed)
+    
+    order = np.argsort(columns, kind='stable')
+    (rows, columns, probabilities) = (rows[order], columns[order], probabilities[order])
+    (targets, starts) = np.unique(columns, return_index=True)
+    
+    # Random numbers of a batch are bounded to around 32 MB.
+    words = samples // 64
+    batch_words = max(1, min(words, (1 << 22) // max(1, len(rows) * 64)))
+    counts = np.zeros(vertex_count, dtype=np.int64)
+    
+    for batch in range(0, words, batch_words):
+        
+        width = min(batch_words, words - batch)
+        successes = np.packbits(rng.random((len(rows), width * 64)) < probabilities[:, None], axis=1,
+                                bitorder='little').view(np.uint64)
+        
+        reached = np.zeros((vertex_count, width), dtype=np.uint64)
+        reached[sources] = np.iinfo(np.uint64).max
+        
+        while len(targets) > 0:
+            incoming = np.bitwise_or.reduceat(reached[rows] & successes, starts, axis=0)
+            updated = reached[targets] | incoming
+            if np.array_equal(updated, reached[targets]):
+                break
+            reached[targets] = updated
+        
+        counts += np.unpackbits(reached.view(np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+    
+    return counts
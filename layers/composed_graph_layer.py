@@ -16,17 +16,25 @@ Layer for manipulation of the attack graphs of networks.
 Including class AttackGraphLayer
 """
 
+import copy
 import time
+import numpy as np
 import networkx as nx
-from collections import deque
+import scipy.sparse as sp
+from typing import Iterator
+from layers.path_engine import LikelyPathEngine
 from layers.attack_graph_layer import AttackGraphLayer
+from layers.attack_graph_store import AttackGraphStore
+from layers.vulnerability_layer import VulnerabilityLayer
 
 
 class ComposedGraphLayer:
     """
     Encapsulation of attack graph over a network.
     Properties:
-        composed_graph: a nx.DiGraph, the attack true graph
+        composed_store: an AttackGraphStore, the attack true graph in arrays
+
+        composed_graph: a nx.DiGraph view of composed_store, the attack true graph
 
         composed_labels: labels for composed_graph, containing detailed CVE entries
 
@@ -34,19 +42,37 @@ class ComposedGraphLayer:
     """
     def __init__(self, attack_graph_layer: AttackGraphLayer):
         
-        self._composed_graph = None
-        self._composed_labels = None
+        self._composed_store = None
         self._attack_graph_layer = attack_graph_layer
+        
+        # Provenance of composed edges, as versions and edge keys of each subnet when it is composed,
+        # and the number of subnets each composed edge comes from.
+        self._provenance: dict[str, (int, np.ndarray)] = dict()
+        self._edge_counts = None
+        self._pruned_edges = None
+        
+        # Engine of likely paths over attack vertices, created when it is first used,
+        # and the version of the composed store it is updated to.
+        self._path_engine = None
+        self._path_engine_version = None
         self.get_graph_compose()
         self.__remove_redundant()
         
+    @property
+    def composed_store(self) -> AttackGraphStore:
+        """
+        Returns:
+            composed_store: an AttackGraphStore, the attack true graph in arrays
+        """
+        return self._composed_store
+    
     @property
     def composed_graph(self) -> nx.DiGraph:
         """
         Returns:
-            composed_graph: a nx.DiGraph, the attack true graph
+            composed_graph: a nx.DiGraph view of composed_store, the attack true graph
         """
-        return self._composed_graph
+        return self.composed_store.graph
     
     @property
     def composed_labels(self) -> dict[((str, str), (str, str)), str]:
@@ -54,7 +80,7 @@ class ComposedGraphLayer:
         Returns:
             composed_labels: labels for composed_graph, containing detailed CVE entries
         """
-        return self._composed_labels
+        return self.composed_store.graph_labels
     
     @property
     def attack_graph_layer(self) -> AttackGraphLayer:
@@ -64,13 +90,9 @@ class ComposedGraphLayer:
         """
         return self._attack_graph_layer
     
-    @composed_graph.setter
-    def composed_graph(self, composed_graph: nx.DiGraph):
-        self._composed_graph = composed_graph
-    
-    @composed_labels.setter
-    def composed_labels(self, composed_labels: dict[((str, str), (str, str)), str]):
-        self._composed_labels = composed_labels
+    @composed_store.setter
+    def composed_store(self, composed_store: AttackGraphStore):
+        self._composed_store = composed_store
     
     @attack_graph_layer.setter
     def attack_graph_layer(self, attack_graph_layer: AttackGraphLayer):
@@ -78,62 +100,206 @@ class ComposedGraphLayer:
     
     def get_graph_compose(self):
         """
-        Composing sub graphs from attack graph layer, and remove redundant edges with depth first search
+        Composing sub graphs from attack graph layer, where only edges of changed subnets are retracted and reinserted
         """
         
         dcg = time.time()
         print('Composing attack graphs from subnets started.')
-        self._composed_labels = dict()
-        
-        if 'full' not in self._attack_graph_layer.attack_graph:
         
-            try:
-                self.composed_graph = nx.compose_all([*self._attack_graph_layer.attack_graph.values()])
-                
-                for subnet in self._attack_graph_layer.graph_labels:
-                    self.composed_labels |= self._attack_graph_layer.graph_labels[subnet]
-            except ValueError:
-                self.composed_graph = nx.DiGraph()
+        attack_stores = self._attack_graph_layer.attack_stores
+        service_uids = self._attack_graph_layer.vulnerability_layer.topology_layer.service_uids
         
+        if 'full' in attack_stores:
+            self.composed_store = attack_stores['full']
+            self._provenance = dict()
+            self._edge_counts = None
+            self._pruned_edges = None
         else:
-            self.composed_graph = self._attack_graph_layer.attack_graph['full']
-            self.composed_labels = self._attack_graph_layer.graph_labels['full']
+            if self._edge_counts is None:
+                self.composed_store = AttackGraphStore(service_uids)
+                self._edge_counts = np.zeros(0, dtype=np.int64)
+            
+            self.__restore_pruned()
+            
+            changed_subnets = [subnet for subnet in attack_stores
+                               if subnet not in self._provenance
+                               or attack_stores[subnet].version != self._provenance[subnet][0]]
+            removed_subnets = [subnet for subnet in self._provenance if subnet not in attack_stores]
+            
+            self.__retract([subnet for subnet in removed_subnets + changed_subnets if subnet in self._provenance])
+            self.__insert(changed_subnets)
+            
+            # Vertices of retracted edges are left only when no edge leads to or from them.
+            edge_vertices = self.composed_store.edges.ravel()
+            self.composed_store.remove_vertices(np.setdiff1d(self.composed_store.vertices, edge_vertices))
         
         dcg = time.time() - dcg
         print(f'Time for composing subnets: {dcg} seconds.')
     
-    # noinspection PyCallingNonCallable
-    def __remove_redundant(self):
+    def fork(self) -> 'ComposedGraphLayer':
+        """
+        Fork the composed graph layer and layers below it, see AttackGraphLayer.fork().
+        The composed store is forked, or taken from forked attack graph stores if it is the full attack graph.
+        Returns:
+            a composed graph layer changed apart from this layer
+        """
         
-        depth_delete_stack = deque()
+        fork = copy.copy(self)
+        fork._attack_graph_layer = self.attack_graph_layer.fork()
+        attack_stores = fork.attack_graph_layer.attack_stores
+        service_uids = fork.attack_graph_layer.vulnerability_layer.topology_layer.service_uids
         
-        for node in self.composed_graph:
-            
-            if self.composed_graph.in_degree(node) == 0:
-                (uid, privilege) = node
-                if uid != 'outside':
-                    depth_delete_stack.append(node)
+        if 'full' in attack_stores and self.composed_store is self.attack_graph_layer.attack_stores['full']:
+            fork._composed_store = attack_stores['full']
+        else:
+            fork._composed_store = self.composed_store.fork(service_uids)
+        fork._provenance = dict(self._provenance)
+        if self._path_engine is not None:
+            fork._path_engine = self._path_engine.fork()
+        return fork
+    
+    def iterate_likely_paths(self, to_n: str, privilege: str = 'ADMIN', from_n: str = 'outside',
+                             threshold: float = 0.0) -> Iterator[tuple[list[(str, str)], float]]:
+        """
+        Iterate loopless paths of attack vertices to a privilege on a service lazily, from the most likely one,
+        see LikelyPathEngine.iterate_paths(). The probability of an edge is 1 - 1.2^(-score) out of the sum
+        over all out edges of its start vertex, as merged graphs do for services, but without rounding.
+        Parameters:
+            to_n: the target service
+            privilege: the privilege to get on to_n, default: 'ADMIN'
+            from_n: where the attacker starts with 'ADMIN', default: 'outside'
+            threshold: the iteration stops before the first path less likely than it
+        Returns:
+            a generator of attack vertices on each path, like [('outside', 'ADMIN'), ('service1', 'USER'), ...],
+            and the probability of the path
+        Raises:
+            ValueError: if any attack vertex is not in the composed graph
+        """
+        
+        service_ids = self.attack_graph_layer.vulnerability_layer.topology_layer.service_ids
+        vertices = self.composed_store.vertices
+        
+        source = service_ids[from_n] * 5 + 4 if from_n in service_ids else -1
+        if not np.isin(source, vertices):
+            raise ValueError(f'Start vertex {(from_n, "ADMIN")} is not in the composed graph.')
+        
+        target = service_ids[to_n] * 5 + VulnerabilityLayer.get_privilege_value(privilege) \
+            if to_n in service_ids else -1
+        if not np.isin(target, vertices):
+            raise ValueError(f'End vertex {(to_n, privilege)} is not in the composed graph.')
+        
+        if self._path_engine is None:
+            self._path_engine = LikelyPathEngine(self.__get_probability_matrix())
+        elif self._path_engine_version != self.composed_store.version:
+            self._path_engine.update(self.__get_probability_matrix())
+        self._path_engine_version = self.composed_store.version
+        
+        paths = self._path_engine.iterate_paths(source, target, threshold)
+        return (([self.composed_store.decode_vertex(vertex) for vertex in path], probability)
+                for (path, probability) in paths)
+    
+    def __get_probability_matrix(self) -> sp.csr_matrix:
+        """
+        Returns:
+            scipy.sparse matrix of probabilities of composed edges, indexed by encoded attack vertices
+        """
         
-        while len(depth_delete_stack) > 0:
-            self.__depth_first_remove(depth_delete_stack)
+        edges = self.composed_store.edges.astype(np.int64)
+        vertex_count = len(self.composed_store.service_uids) * 5
+        values = 1 - 1.2 ** -self.composed_store.scores
+        totals = np.bincount(edges[:, 0], weights=values, minlength=vertex_count)
+        
+        # Edges with no score are never taken, as merged graphs never take them either.
+        is_scored = values > 0
+        probabilities = values[is_scored] / totals[edges[is_scored, 0]]
+        return sp.csr_matrix((probabilities, (edges[is_scored, 0], edges[is_scored, 1])),
+                             shape=(vertex_count, vertex_count))
     
-    # noinspection PyCallingNonCallable
-    def __depth_first_remove(self, depth_delete_stack: deque):
+    def __retract(self, subnets: list[str]):
+        """
+        Retract edges of subnets from the composed graph, where an edge is removed when no other subnet has it
+        Parameters:
+            subnets: subnets composed before
+        """
+        
+        if len(subnets) == 0:
+            return
+        
+        retracted_keys = np.concatenate([self._provenance.pop(subnet)[1] for subnet in subnets])
+        composed_keys = self.composed_store.get_edge_keys()
+        key_order = np.argsort(composed_keys)
+        positions = key_order[np.searchsorted(composed_keys[key_order], retracted_keys)]
+        
+        # Counts are replaced rather than changed in place, since they are shared with forks.
+        self._edge_counts = self._edge_counts - np.bincount(positions, minlength=len(self._edge_counts))
+        
+        removed = self._edge_counts == 0
+        self.composed_store.remove_edges(removed)
+        self._edge_counts = self._edge_counts[~removed]
     
-        node_to_remove = depth_delete_stack.pop()
-        edges_to_remove = []
-        end_nodes = set()
-        
-        out_edges = self.composed_graph.out_edges(node_to_remove)
-        for out_edge in out_edges:
-            (start_node, end_node) = out_edge
-            edges_to_remove.append(out_edge)
-            del self.composed_labels[out_edge]
-            end_nodes.add(end_node)
-        
-        for end_node in end_nodes:
-            
-            if self.composed_graph.in_degree(end_node) == 0:
-                depth_delete_stack.append(end_node)
+    def __insert(self, subnets: list[str]):
+        """
+        Insert edges of subnets into the composed graph, in order of subnets, where the first label of an edge is kept
+        Parameters:
+            subnets: subnets not composed yet
+        """
+        
+        if len(subnets) == 0:
+            return
+        
+        attack_stores = self._attack_graph_layer.attack_stores
+        subnet_keys = [attack_stores[subnet].get_edge_keys() for subnet in subnets]
+        inserted_keys = np.concatenate(subnet_keys)
+        
+        composed_keys = self.composed_store.get_edge_keys()
+        key_order = np.argsort(composed_keys)
+        positions = np.searchsorted(composed_keys[key_order], inserted_keys)
+        found = positions < len(composed_keys)
+        found[found] = composed_keys[key_order[positions[found]]] == inserted_keys[found]
+        self._edge_counts = self._edge_counts + np.bincount(key_order[positions[found]],
+                                                            minlength=len(self._edge_counts))
+        
+        # New edges are added by their first occurrences, counting the subnets they come from.
+        new_indices = np.flatnonzero(~found)
+        (_, first_indices, counts) = np.unique(inserted_keys[new_indices], return_index=True, return_counts=True)
+        first_order = np.argsort(first_indices)
+        is_first = np.zeros(len(inserted_keys), dtype=bool)
+        is_first[new_indices[first_indices]] = True
+        
+        start = 0
+        for subnet, keys in zip(subnets, subnet_keys):
+            store = attack_stores[subnet]
+            self.composed_store.add_edges(*store.select_edges(is_first[start:start + len(keys)]))
+            self._provenance[subnet] = (store.version, keys)
+            start += len(keys)
+        
+        self._edge_counts = np.concatenate([self._edge_counts, counts[first_order]])
+    
+    def __restore_pruned(self):
+        """
+        Add edges removed by __remove_redundant() back, so that the composed graph has edges of all subnets again
+        """
+        
+        if self._pruned_edges is not None:
+            (edges, label_offsets, labels, scores, counts) = self._pruned_edges
+            self.composed_store.add_edges(edges, label_offsets, labels, scores)
+            self._edge_counts = np.concatenate([self._edge_counts, counts])
+            self._pruned_edges = None
     
-        self.composed_graph.remove_node(node_to_remove)
+    def __remove_redundant(self):
+        """
+        Remove attack vertices not reachable from outside, with all their edges, in one bulk filter
+        """
+        
+        # Vertices of outside are encoded as 0 to 4.
+        reachable = self.composed_store.get_reachable(np.arange(5))
+        vertices = self.composed_store.vertices
+        vertices_to_remove = vertices[~reachable[vertices]]
+        
+        if len(vertices_to_remove) > 0:
+            removed = ~reachable[self.composed_store.edges[:, 0]]
+            if self._edge_counts is not None:
+                self._pruned_edges = (*self.composed_store.select_edges(removed), self._edge_counts[removed])
+                self._edge_counts = self._edge_counts[~removed]
+            self.composed_store.remove_edges(removed)
+            self.composed_store.remove_vertices(vertices_to_remove)
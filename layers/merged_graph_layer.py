@@ -17,17 +17,28 @@ Including class MergedGraphLayer
 """
 
 from layers.composed_graph_layer import ComposedGraphLayer
-from collections import deque
+from layers.bayesian_engine import SparseBayesianEngine
+from layers.path_engine import LikelyPathEngine
+from concurrent.futures import wait
+from typing import Iterator
 import networkx as nx
+import scipy.sparse as sp
+from scipy.sparse.csgraph import maximum_flow, breadth_first_order
+import numpy as np
+import contextlib
+import itertools
+import copy
+import pickle
 import math
 import time
+import os
 
 
 class MergedGraphLayer:
     """
     Encapsulation of merged graph over a network for bayesian probabilities.
     Properties:
-        merged_graph: a nx.DiGraph, merging the services of attack graphs
+        merged_graph: a nx.DiGraph view of merged edges, merging the services of attack graphs, built on access
         
         merged_labels: labels for merged_graph
 
@@ -43,12 +54,25 @@ class MergedGraphLayer:
         """
         print('Graph merging started.')
         tm = time.time()
-        self._merged_graph = nx.DiGraph()
+        self._merged_graph = None
+        self._merged_services = set()
         self._merged_labels = dict()
-        self._weighted_edges = list()
-        self._edge_start_from = dict()
+        self._edge_start_from: dict[str, set[(str, str)]] = dict()
+        
+        # Merged edges of the last merge, sorted by keys of service pairs, start id << 32 | end id,
+        # with keys and label lengths, and scores of the composed edges they are merged from.
+        self._pair_keys = np.zeros(0, dtype=np.int64)
+        self._pair_edges = np.zeros((0, 2), dtype=np.int64)
+        self._pair_scores = np.zeros(0, dtype=np.float64)
         self._composed_graph_layer = composed_graph_layer
         self._service_probabilities = None
+        self._bayesian_engine = None
+        
+        # Shortest path trees of most likely paths are only searched on the first query.
+        self._path_engine = None
+        
+        # Labels, out edges and probabilities are shared with forks, until either of them merges again.
+        self._shared = False
         self.merge()
         tm = time.time() - tm
         print(f'Time for graph merging: {tm} seconds.')
@@ -57,8 +81,12 @@ class MergedGraphLayer:
     def merged_graph(self) -> nx.DiGraph:
         """
         Returns:
-            merged_graph: a nx.DiGraph, merging the services of attack graphs
+            merged_graph: a nx.DiGraph view of merged edges, merging the services of attack graphs, built on access
         """
+        if self._merged_graph is None:
+            self._merged_graph = nx.DiGraph()
+            self._merged_graph.add_edges_from([(start_service, service, self.merged_labels[(start_service, service)])
+                                               for (start_service, service) in self.merged_labels])
         return self._merged_graph
     
     @property
@@ -85,10 +113,6 @@ class MergedGraphLayer:
         """
         return self._service_probabilities
     
-    @merged_graph.setter
-    def merged_graph(self, merged_graph: nx.DiGraph):
-        self._merged_graph = merged_graph
-    
     @composed_graph_layer.setter
     def composed_graph_layer(self, composed_graph_layer: ComposedGraphLayer):
         self._composed_graph_layer = composed_graph_layer
@@ -105,40 +129,78 @@ class MergedGraphLayer:
     def merge(self):
         """
         Merging composed graphs, where same services with different privileges are treated as one.
-        Then compute the weight by CVSS score.
+        Then compute the weight by CVSS scores of edges, which are scored where they are generated.
         """
         
         tm = time.time()
+        self.__unshare()
         
-        for label in self.composed_graph_layer.composed_labels:
-            
-            (start_service, privilege1), (service, privilege2) = label
+        composed_store = self.composed_graph_layer.composed_store
+        service_uids = composed_store.service_uids
+        offsets = composed_store.label_offsets
+        labels = composed_store.labels
+        
+        # Edges between privileges of the same service are merged away.
+        edge_ids = composed_store.edges.astype(np.int64) // 5
+        cross_edges = np.flatnonzero(edge_ids[:, 0] != edge_ids[:, 1])
+        scores = composed_store.scores[cross_edges]
+        pair_keys = (edge_ids[cross_edges, 0] << 32) | edge_ids[cross_edges, 1]
+        
+        # The lightest edge of each pair of services has the highest score, where ties keep the first edge.
+        order = np.lexsort((-scores, pair_keys))
+        is_lightest = np.ones(len(order), dtype=bool)
+        is_lightest[1:] = pair_keys[order[1:]] != pair_keys[order[:-1]]
+        lightest = order[is_lightest]
+        
+        new_pair_keys = pair_keys[lightest]
+        merged_edges = cross_edges[lightest]
+        new_pair_edges = np.column_stack([composed_store.get_edge_keys()[merged_edges], np.diff(offsets)[merged_edges]])
+        new_pair_scores = scores[lightest]
+        
+        # Only pairs added, removed, or merged from another composed edge are applied to merged_labels.
+        is_old = np.isin(new_pair_keys, self._pair_keys)
+        is_kept = np.isin(self._pair_keys, new_pair_keys)
+        is_changed = ~is_old
+        is_changed[is_old] = (new_pair_edges[is_old] != self._pair_edges[is_kept]).any(axis=1) \
+            | (new_pair_scores[is_old] != self._pair_scores[is_kept])
+        removed_pairs = self._pair_keys[~is_kept]
+        
+        # Pairs keep the order they first appear in, as they are added to merged_labels.
+        (_, first_indices) = np.unique(pair_keys, return_index=True)
+        changed_pairs = np.flatnonzero(is_changed)
+        changed_pairs = changed_pairs[np.argsort(first_indices[changed_pairs], kind='stable')]
+        
+        changed_labels: set[(str, str)] = set()
+        for pair_key in removed_pairs.tolist():
             
-            if start_service == service:
-                continue
+            removed_label = (service_uids[pair_key >> 32], service_uids[pair_key & 0xFFFFFFFF])
+            del self.merged_labels[removed_label]
+            changed_labels.add(removed_label)
             
-            vulnerabilities = self.composed_graph_layer.composed_labels[label]
-            score = 0
-            for vulnerability in vulnerabilities.split('\n'):
-                if vulnerability != '':
-                    scores = self.composed_graph_layer.attack_graph_layer.vulnerability_layer.scores
-                    score = max(score, scores[vulnerability])
-            weight_to_compare = MergedGraphLayer.__get_weight_from_score(score)
-            new_label = (start_service, service)
+            self._edge_start_from[removed_label[0]].remove(removed_label)
+            if len(self._edge_start_from[removed_label[0]]) == 0:
+                del self._edge_start_from[removed_label[0]]
+        
+        for i, score in zip(merged_edges[changed_pairs].tolist(), new_pair_scores[changed_pairs].tolist()):
             
-            if new_label in self.merged_labels \
-                    and weight_to_compare >= self.merged_labels[new_label]['weight']:
-                continue
+            start_service = service_uids[edge_ids[i, 0]]
+            service = service_uids[edge_ids[i, 1]]
             
-            self.merged_labels[new_label] = {'weight': weight_to_compare, 'CVE': vulnerabilities}
+            new_label = (start_service, service)
+            self.merged_labels[new_label] = {'weight': MergedGraphLayer.__get_weight_from_score(score),
+                                             'CVE': labels[offsets[i]:offsets[i + 1]]}
+            changed_labels.add(new_label)
             
-            self._edge_start_from: dict[str, set[(str, str)]]
             if start_service in self._edge_start_from:
                 self._edge_start_from[start_service].add(new_label)
             else:
                 self._edge_start_from[start_service] = {new_label}
         
-        for service in self._edge_start_from:
+        # Probabilities of out edges are normalised again, only for services with changed out edges.
+        for service in {start_service for (start_service, _) in changed_labels}:
+            
+            if service not in self._edge_start_from:
+                continue
             
             total_value = 0
             out_edges = self._edge_start_from[service]
@@ -147,33 +209,95 @@ class MergedGraphLayer:
                 total_value += 1 - weight
             for out_edge in out_edges:
                 weight = self.merged_labels[out_edge]['weight']
-                self.merged_labels[out_edge]['probability'] = math.trunc((1 - weight) / total_value * 100) / 100
+                
+                # Labels are replaced rather than changed in place, since they are shared with forks.
+                self.merged_labels[out_edge] = self.merged_labels[out_edge] \
+                    | {'probability': math.trunc((1 - weight) / total_value * 100) / 100}
+                changed_labels.add(out_edge)
         
-        for label in self.merged_labels:
-            start_service, service = label
-            self._weighted_edges.append((start_service, service, self.merged_labels[label]))
+        self._pair_keys = new_pair_keys
+        self._pair_edges = new_pair_edges
+        self._pair_scores = new_pair_scores
+        self._merged_services = {service_uids[i] for i in np.unique(edge_ids[merged_edges]).tolist()}
+        
+        if self._merged_graph is not None:
+            self.__patch_merged_graph(changed_labels)
         
-        self.merged_graph.add_edges_from(self._weighted_edges)
         self.__get_bayesian_probabilities()
+        if self._path_engine is not None:
+            self._path_engine.update(self._bayesian_engine.probability_matrix)
         
         tm = time.time() - tm
         print(f'Time for merging graphs: {tm} seconds.')
     
-    def gen_defence_list(self, to_n: str = None, from_n='outside') -> dict[str, int]:
+    def fork(self) -> 'MergedGraphLayer':
+        """
+        Fork the merged graph layer and all layers below it, for what-if analysis from this layer as a baseline.
+        Nothing is deep copied, containers are shared until either layer changes them, see ComposedGraphLayer.fork(),
+        so that forks take memory for their differences, and changes made to a fork are never seen by this layer.
+        Returns:
+            a merged graph layer changed apart from this layer
+        """
+        
+        fork = copy.copy(self)
+        fork._composed_graph_layer = self.composed_graph_layer.fork()
+        fork._merged_graph = None
+        if self._bayesian_engine is not None:
+            topology_layer = fork.composed_graph_layer.attack_graph_layer.vulnerability_layer.topology_layer
+            fork._bayesian_engine = self._bayesian_engine.fork(topology_layer)
+        if self._path_engine is not None:
+            fork._path_engine = self._path_engine.fork()
+        fork._shared = self._shared = True
+        return fork
+    
+    def __unshare(self):
+        """
+        Copy labels, out edges and probabilities shared with forks before they are changed, where labels are shared
+        """
+        
+        if self._shared:
+            self._merged_labels = dict(self._merged_labels)
+            self._edge_start_from = {service: set(out_edges) for (service, out_edges) in self._edge_start_from.items()}
+            self._service_probabilities = dict(self._service_probabilities)
+            self._shared = False
+    
+    def __patch_merged_graph(self, changed_labels: set[(str, str)]):
+        """
+        Apply changed labels to merged_graph in place, rather than building it again
+        Parameters:
+            changed_labels: labels added, removed, or with changed weights or probabilities
+        """
+        
+        for (start_service, service) in changed_labels:
+            if (start_service, service) in self.merged_labels:
+                self._merged_graph.add_edge(start_service, service, **self.merged_labels[(start_service, service)])
+            elif self._merged_graph.has_edge(start_service, service):
+                self._merged_graph.remove_edge(start_service, service)
+        
+        self._merged_graph.remove_nodes_from([service for service in [*self._merged_graph.nodes]
+                                              if service not in self._merged_services])
+    
+    def gen_defence_list(self, to_n: str = None, from_n='outside', mode: str = 'path') -> dict[str, int]:
         """
-        Generate a list of services to deploy honeypots, based on connectivities and probabilities
+        Generate a list of services to deploy honeypots, based on connectivities and probabilities,
+        where services on the most likely path to to_n are counted, see get_likely_paths(),
+        or services of the cheapest cut between from_n and to_n, see get_minimum_cut()
         Parameters
             to_n:
             from_n:
+            mode: 'path' for the most likely path, 'cut' for the minimum vertex cut
         Returns:
             A list of services to deploy honeypots.
         """
-        if from_n not in self.merged_graph:
+        if from_n not in self._merged_services:
             raise ValueError(f'Start service {from_n} is not in the merged graph.')
         
-        if to_n is not None and to_n not in self.merged_graph:
+        if to_n is not None and to_n not in self._merged_services:
             raise ValueError(f'End service {to_n} is not in the merged graph.')
         
+        if mode not in {'path', 'cut'}:
+            raise ValueError(f'Mode {mode} is invalid, it must be \'path\' or \'cut\'.')
+        
         tg = time.time()
         path_counts: dict[str, int] = dict()
         topology_layer = self.composed_graph_layer.attack_graph_layer.vulnerability_layer.topology_layer
@@ -182,7 +306,15 @@ class MergedGraphLayer:
             path_counts[gateway] = degree
 
         if to_n is not None:
-            for service in nx.shortest_path(self.merged_graph, from_n, to_n):
+            if mode == 'cut':
+                (path, cost) = self.get_minimum_cut(to_n, from_n)
+                if math.isinf(cost):
+                    print(f'No cut separates {to_n} from {from_n}, only gateways are protected.')
+            else:
+                (path, _) = self.get_likely_paths([to_n], from_n)[to_n]
+                if len(path) == 0:
+                    print(f'No path from {from_n} to {to_n} has a probability above 0, only gateways are protected.')
+            for service in path:
                 if service in path_counts:
                     path_counts[service] = path_counts[service] + 1
                 else:
@@ -192,6 +324,87 @@ class MergedGraphLayer:
         print(f'Time for generating defence list: {tg} seconds.')
         return path_counts
     
+    def get_minimum_cut(self, to_n: str, from_n: str = 'outside', capacity: str = 'probability') -> (list[str], float):
+        """
+        Get the cheapest services to cut every path from from_n to to_n, by one maximum flow over merged edges
+        with probabilities above 0. Each service is split into an in vertex and an out vertex joined by its capacity,
+        and merged edges have unbounded capacities, so that minimum cuts of the flow are cuts of services.
+        The capacity of a service is the sum of a label over edges to it, where 'probability' makes cuts where
+        attacks are least likely to pass, 'weight' makes cuts where vulnerabilities are the most severe,
+        and None makes cuts of the fewest services.
+        Parameters:
+            to_n: the service to protect
+            from_n: where attacks start
+            capacity: 'probability', 'weight' or None
+        Returns:
+            services of the cut and the sum of their capacities, which is empty with an infinite cost
+            if from_n has an edge to to_n, or empty with 0 if to_n is not reached at all
+        Raises:
+            ValueError: if any service is not in the merged graph, or capacity is invalid
+        """
+        
+        if from_n not in self._merged_services:
+            raise ValueError(f'Start service {from_n} is not in the merged graph.')
+        
+        if to_n not in self._merged_services:
+            raise ValueError(f'End service {to_n} is not in the merged graph.')
+        
+        if capacity not in {'probability', 'weight', None}:
+            raise ValueError(f'Capacity {capacity} is invalid, it must be \'probability\', \'weight\' or None.')
+        
+        tc = time.time()
+        topology_layer = self.composed_graph_layer.attack_graph_layer.vulnerability_layer.topology_layer
+        service_ids = topology_layer.service_ids
+        service_uids = topology_layer.service_uids
+        (source, sink) = (service_ids[from_n], service_ids[to_n])
+        
+        starts = self._pair_keys >> 32
+        ends = self._pair_keys & 0xFFFFFFFF
+        probabilities = np.zeros(len(starts))
+        if len(starts) > 0:
+            probabilities = np.asarray(self._bayesian_engine.probability_matrix[starts, ends], dtype=np.float64).ravel()
+        is_likely = probabilities > 0
+        (starts, ends) = (starts[is_likely], ends[is_likely])
+        
+        if capacity == 'probability':
+            edge_capacities = probabilities[is_likely]
+        elif capacity == 'weight':
+            edge_capacities = MergedGraphLayer.__get_weight_from_score(self._pair_scores[is_likely])
+        else:
+            edge_capacities = np.ones(len(starts))
+        
+        # Capacities are scaled to integers, and the source and the sink are never cut.
+        vertex_count = len(service_uids)
+        service_capacities = np.bincount(ends, weights=edge_capacities, minlength=vertex_count)
+        scale = min(1e6, 2 ** 30 / max(service_capacities.sum(), 1))
+        scaled_capacities = np.ceil(service_capacities * scale).astype(np.int64)
+        unbounded = int(scaled_capacities.sum()) + 1
+        scaled_capacities[[source, sink]] = unbounded
+        
+        # Service i is split into vertex i for edges into it, and vertex i + vertex_count for edges out of it.
+        services = np.arange(vertex_count)
+        rows = np.concatenate([services, starts + vertex_count])
+        columns = np.concatenate([services + vertex_count, ends])
+        capacities = np.concatenate([scaled_capacities, np.full(len(starts), unbounded, dtype=np.int64)])
+        flow_matrix = sp.csr_matrix((capacities.astype(np.int32), (rows, columns)),
+                                    shape=(vertex_count * 2, vertex_count * 2))
+        
+        result = maximum_flow(flow_matrix, source, sink + vertex_count, method='dinic')
+        tc = time.time() - tc
+        print(f'Time for searching minimum cut: {tc} seconds.')
+        if result.flow_value >= unbounded:
+            return [], math.inf
+        
+        # Services of the cut are those whose in vertices are reached in the residual graph but out vertices are not.
+        residual_matrix = (flow_matrix - result.flow).tocsr()
+        residual_matrix.data[residual_matrix.data < 0] = 0
+        residual_matrix.eliminate_zeros()
+        reached = np.zeros(vertex_count * 2, dtype=bool)
+        reached[breadth_first_order(residual_matrix, source, directed=True, return_predecessors=False)] = True
+        cut = np.flatnonzero(reached[:vertex_count] & ~reached[vertex_count:])
+        
+        return [service_uids[i] for i in cut.tolist()], float(service_capacities[cut].sum())
+    
     def deploy_honeypot(self, path_counts, minimum):
         """
         Deploy honeypots based on the list
@@ -204,8 +417,6 @@ class MergedGraphLayer:
         vulnerability_layer = attack_graph_layer.vulnerability_layer
         topology_layer = vulnerability_layer.topology_layer
         
-        affected_subnets = set()
-        
         task = 'nginx'
         
         td = time.time()
@@ -225,84 +436,212 @@ class MergedGraphLayer:
             
             topology_layer[honeypot_uid] = new_service
             vulnerability_layer[honeypot_uid] = task
-            
-            for subnet in old_subnets:
-                affected_subnets.add(subnet)
+            attack_graph_layer.add_service(honeypot_uid)
             
             print(f'Honeypot {honeypot_uid} deployed at {uid}.')
             h += 1
         
         td = time.time() - td
         print(f'Time for deploying honeypots: {td} seconds.')
-        attack_graph_layer.update_by_subnets(list(affected_subnets))
         self.composed_graph_layer.get_graph_compose()
         self.merge()
     
+    def optimise_honeypots(self, to_n: str, budget: int = 1, top_k: int = 5, candidates: list[str] = None,
+                           task: str = 'nginx') -> list[((str, ...), float)]:
+        """
+        Search placements of honeypots lowering the probability of a target the most.
+        Every placement within the budget is evaluated on its own copy of the layers,
+        across the process pool of the attack graph layer, see evaluate_honeypot_placements().
+        As deploy_honeypot() does, a honeypot placed at a service joins all subnets of the service.
+        Parameters:
+            to_n: the target to protect
+            budget: the most honeypots in a placement
+            top_k: the number of placements to return
+            candidates: services where honeypots can be placed, default to services of gen_defence_list(to_n)
+            task: task of honeypots
+        Returns:
+            the best placements, and how much they lower the probability of to_n, from the highest
+        Raises:
+            ValueError: if to_n is not in the merged graph
+        """
+        
+        if to_n not in self._merged_services:
+            raise ValueError(f'End service {to_n} is not in the merged graph.')
+        
+        attack_graph_layer = self.composed_graph_layer.attack_graph_layer
+        vulnerability_layer = attack_graph_layer.vulnerability_layer
+        topology_layer = vulnerability_layer.topology_layer
+        executor = attack_graph_layer.executor
+        workers = max(1, vulnerability_layer.config['nums-of-processes'])
+        
+        if candidates is None:
+            candidates = [*self.gen_defence_list(to_n).keys()]
+        candidates = [service for service in candidates if service != 'outside' and service in topology_layer.services]
+        placements: list[(str, ...)] = [*itertools.chain.from_iterable(itertools.combinations(candidates, size)
+                                                                       for size in range(1, budget + 1))]
+        
+        to = time.time()
+        
+        # The layers are pickled once for each task, and every placement is evaluated on a fork of them.
+        baseline = pickle.dumps(self)
+        (exploitable, scores) = vulnerability_layer.get_exploitable(task)
+        
+        if executor is None:
+            probabilities = evaluate_honeypot_placements(baseline, placements, to_n, task, exploitable, scores)
+        else:
+            # One task per worker, so that the layers are sent to each worker only once.
+            tasks = min(workers, len(placements))
+            futures = [executor.submit(evaluate_honeypot_placements, baseline, placements[i::tasks], to_n, task,
+                                       exploitable, scores) for i in range(tasks)]
+            wait(futures)
+            
+            probabilities = [0.0] * len(placements)
+            for i, future in enumerate(futures):
+                probabilities[i::tasks] = future.result()
+        
+        probability = self.service_probabilities.get(to_n, 0)
+        reductions = [probability - new_probability for new_probability in probabilities]
+        
+        # Ties prefer fewer honeypots, then the order of candidates.
+        ranking = sorted(range(len(placements)), key=lambda i: (-reductions[i], len(placements[i]), i))
+        
+        to = time.time() - to
+        print(f'Time for evaluating {len(placements)} honeypot placements: {to} seconds.')
+        return [(placements[i], reductions[i]) for i in ranking[:top_k]]
+    
     def __get_bayesian_probabilities(self, from_n='outside'):
         """
-        Get bayesian probabilities for all services presenting in subnets
+        Get bayesian probabilities for all services presenting in subnets, see SparseBayesianEngine.
+        After the first merge, probabilities are patched in place, where only changed services are recomputed.
         Parameters:
             from_n: where search starts
         """
         
-        self.service_probabilities = dict()
+        if self._bayesian_engine is None:
+            topology_layer = self.composed_graph_layer.attack_graph_layer.vulnerability_layer.topology_layer
+            self._bayesian_engine = SparseBayesianEngine(topology_layer, self.merged_labels)
+            self.service_probabilities = self._bayesian_engine.get_probabilities(self._merged_services, from_n)
+        else:
+            self._bayesian_engine.update_labels(self.merged_labels)
+            changed_services = self._bayesian_engine.refresh_probabilities(self.service_probabilities,
+                                                                           self._merged_services, from_n)
+            print(f'Bayesian probabilities of {len(changed_services)} services are refreshed.')
+    
+    def get_likely_paths(self, targets: list[str], from_n: str = 'outside') -> dict[str, (list[str], float)]:
+        """
+        Get the most likely paths to many targets, where the probability of a path is the product of probabilities
+        of its edges. All targets share one shortest path tree of from_n, cached until merges change it,
+        see LikelyPathEngine.
+        Parameters:
+            targets: services to reach
+            from_n: where attacks start
+        Returns:
+            a dict of targets, and services on their paths with probabilities of the paths,
+            where targets with no path of a probability above 0 have an empty path
+        Raises:
+            ValueError: if any service is not in the merged graph
+        """
         
-        if from_n not in self.merged_graph.nodes:
-            raise ValueError(f'service \'{from_n}\' undefined in merged graph.')
+        if from_n not in self._merged_services:
+            raise ValueError(f'Start service {from_n} is not in the merged graph.')
         
-        self.service_probabilities[from_n] = 1
+        for service in targets:
+            if service not in self._merged_services:
+                raise ValueError(f'End service {service} is not in the merged graph.')
         
-        queue = deque()
-        queue.append(from_n)
+        topology_layer = self.composed_graph_layer.attack_graph_layer.vulnerability_layer.topology_layer
+        service_ids = topology_layer.service_ids
+        service_uids = topology_layer.service_uids
         
-        while len(queue) > 0:
-            self.breadth_first_bayesian(queue)
+        paths = self.__get_path_engine().get_paths(service_ids[from_n], [service_ids[service] for service in targets])
+        return {service: ([service_uids[i] for i in path], probability)
+                for service, (path, probability) in zip(targets, paths)}
     
-    def breadth_first_bayesian(self, queue: deque):
+    def iterate_likely_paths(self, to_n: str, from_n: str = 'outside', threshold: float = 0.0) \
+            -> Iterator[tuple[list[str], float]]:
         """
-        breadth first search throw services for bayesian probabilities
-        Parameter
-            queue: queue object
+        Iterate loopless paths to a target lazily, from the most likely one, see LikelyPathEngine.iterate_paths().
+        Taking the top k paths is itertools.islice(self.iterate_likely_paths(to_n), k).
+        Paths are of the merged graph when it is called, even if it is merged again during the iteration.
+        Parameters:
+            to_n: the service to reach
+            from_n: where attacks start
+            threshold: the iteration stops before the first path less likely than it
+        Returns:
+            a generator of services on each path, and the probability of the path
+        Raises:
+            ValueError: if any service is not in the merged graph
         """
-        has_bayesian = queue.popleft()
+        
+        if from_n not in self._merged_services:
+            raise ValueError(f'Start service {from_n} is not in the merged graph.')
+        
+        if to_n not in self._merged_services:
+            raise ValueError(f'End service {to_n} is not in the merged graph.')
         
         topology_layer = self.composed_graph_layer.attack_graph_layer.vulnerability_layer.topology_layer
-        neighbours = topology_layer.get_neighbours(topology_layer.services, topology_layer.subnets, has_bayesian)
+        service_ids = topology_layer.service_ids
+        service_uids = topology_layer.service_uids
         
-        for neighbour in neighbours:
-            
-            if neighbour not in self.merged_graph.nodes:
-                continue
-            
-            if neighbour in self.service_probabilities:
-                continue
-            
-            edge = (has_bayesian, neighbour)
-            
-            neighbour_probability = 0
-            
-            if 'honey' not in neighbour:
-                if edge in self.merged_labels:
-                    neighbour_probability += self.service_probabilities[has_bayesian] \
-                        * self.merged_labels[edge]['probability']
-                
-                for neighbour_of_neighbour in neighbours:
-                    
-                    if neighbour_of_neighbour not in self.merged_graph.nodes:
-                        continue
-                    
-                    start_edge = (has_bayesian, neighbour_of_neighbour)
-                    end_edge = (neighbour_of_neighbour, neighbour)
-                    if start_edge not in self.merged_labels or end_edge not in self.merged_labels:
-                        continue
-                    
-                    neighbour_probability += self.merged_labels[start_edge]['probability'] \
-                        * self.merged_labels[end_edge]['probability']
-            
-            if neighbour in topology_layer.gateway_services:
-                queue.append(neighbour)
-            
-            self.service_probabilities[neighbour] = neighbour_probability
+        paths = self.__get_path_engine().iterate_paths(service_ids[from_n], service_ids[to_n], threshold)
+        return (([service_uids[i] for i in path], probability) for (path, probability) in paths)
+    
+    def __get_path_engine(self) -> LikelyPathEngine:
+        """
+        Returns:
+            the engine of likely paths over probabilities of the merged graph, created when it is first used
+        """
+        
+        if self._path_engine is None:
+            self._path_engine = LikelyPathEngine(self._bayesian_engine.probability_matrix)
+        return self._path_engine
+    
+    def get_probability_table(self, sources: list[str], targets: list[str]) -> np.ndarray:
+        """
+        Get bayesian probabilities from many entry points to many targets in one pass, see SparseBayesianEngine
+        Parameters:
+            sources: services where attacks start, like ['outside']
+            targets: services to protect
+        Returns:
+            float64 array of sources × targets, where unreachable targets have probability 0
+        Raises:
+            ValueError: if any service is not in the merged graph
+        """
+        
+        for service in targets:
+            if service not in self._merged_services:
+                raise ValueError(f'End service {service} is not in the merged graph.')
+        
+        tp = time.time()
+        probability_table = self._bayesian_engine.get_probability_table(self._merged_services, sources, targets)
+        tp = time.time() - tp
+        print(f'Time for probabilities of {len(sources)} sources and {len(targets)} targets: {tp} seconds.')
+        return probability_table
+    
+    def estimate_compromise_probabilities(self, samples: int = 10000, from_n: str = 'outside',
+                                          confidence: float = 0.95, seed: int = None) \
+            -> dict[str, (float, float, float)]:
+        """
+        Estimate probabilities that services are compromised by sampling, over all attack paths,
+        with the process pool of the attack graph layer, see SparseBayesianEngine.estimate_probabilities()
+        Parameters:
+            samples: the number of realisations of the merged graph
+            from_n: where attacks start
+            confidence: confidence level of intervals
+            seed: seed of random streams, or None for a random seed
+        Returns:
+            a dict of services, and their estimated probabilities with lower and upper bounds of confidence intervals
+        """
+        
+        attack_graph_layer = self.composed_graph_layer.attack_graph_layer
+        workers = max(1, attack_graph_layer.vulnerability_layer.config['nums-of-processes'])
+        
+        te = time.time()
+        estimates = self._bayesian_engine.estimate_probabilities(self._merged_services, from_n, samples, confidence,
+                                                                 attack_graph_layer.executor, workers, seed)
+        te = time.time() - te
+        print(f'Time for estimating compromise probabilities by {samples} samples: {te} seconds.')
+        return estimates
     
     def __setitem__(self, uid: str, new_service: dict[str]):
         """
@@ -313,7 +652,6 @@ class MergedGraphLayer:
         """
         
         task = new_service['tasks']
-        new_subnets = new_service['subnets']
         
         attack_graph_layer = self.composed_graph_layer.attack_graph_layer
         vulnerability_layer = attack_graph_layer.vulnerability_layer
@@ -321,7 +659,7 @@ class MergedGraphLayer:
         
         topology_layer[uid] = new_service
         vulnerability_layer[uid] = task
-        attack_graph_layer.update_by_subnets(new_subnets)
+        attack_graph_layer.add_service(uid)
         self.composed_graph_layer.get_graph_compose()
         self.merge()
         
@@ -342,7 +680,7 @@ class MergedGraphLayer:
         
         del topology_layer[uid]
         del vulnerability_layer[uid]
-        attack_graph_layer.update_by_subnets(affected_subnets)
+        attack_graph_layer.remove_service(uid, affected_subnets)
         self.composed_graph_layer.get_graph_compose()
         self.merge()
         
@@ -400,3 +738,48 @@ class MergedGraphLayer:
         
         weight = 1.2 ** -score
         return weight
+
+
+def evaluate_honeypot_placements(baseline: bytes, placements: list[(str, ...)], to_n: str, task: str,
+                                 exploitable: dict[str, dict], scores: dict[str, int]) -> list[float]:
+    """
+    Evaluate placements of honeypots, each on a fork of the layers, see MergedGraphLayer.fork().
+    Honeypots are added as MergedGraphLayer.deploy_honeypot() does, so that attack graphs are patched,
+    composed and merged incrementally, and only probabilities changed by honeypots are refreshed.
+    Parameters:
+        baseline: a pickled MergedGraphLayer, with all layers bound to it
+        placements: services next to which honeypots are placed
+        to_n: the target
+        task: task of honeypots
+        exploitable: the entry of exploitable_vulnerabilities for honeypots, see VulnerabilityLayer.get_exploitable()
+        scores: CVSS scores of vulnerabilities of honeypots
+    Returns:
+        probabilities of to_n after each placement
+    """
+    
+    probabilities: list[float] = list()
+    baseline_layer: MergedGraphLayer = pickle.loads(baseline)
+    
+    # Layers print their progress, which is of no use for forks thrown away.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for placement in placements:
+            
+            merged_graph_layer = baseline_layer.fork()
+            attack_graph_layer = merged_graph_layer.composed_graph_layer.attack_graph_layer
+            vulnerability_layer = attack_graph_layer.vulnerability_layer
+            topology_layer = vulnerability_layer.topology_layer
+            
+            h = 0
+            for uid in placement:
+                while (honeypot_uid := 'honey-' + str(h)) in topology_layer.service_ids:
+                    h += 1
+                
+                topology_layer[honeypot_uid] = {'tasks': task, 'subnets': topology_layer.services[uid]['subnets']}
+                vulnerability_layer.set_exploitable(honeypot_uid, exploitable, scores)
+                attack_graph_layer.add_service(honeypot_uid)
+            
+            merged_graph_layer.composed_graph_layer.get_graph_compose()
+            merged_graph_layer.merge()
+            probabilities.append(merged_graph_layer.service_probabilities.get(to_n, 0))
+    
+    return probabilities
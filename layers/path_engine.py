@@ -0,0 +1,384 @@
+#  Copyright 2022 Hanwen Zhang
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  Unless required by applicable law or agreed to in writing, software.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Most likely attack paths over graphs of edge probabilities, with cached shortest path trees.
+Including class LikelyPathEngine
+"""
+
+import copy
+import heapq
+import math
+import numpy as np
+import scipy.sparse as sp
+from typing import Iterator
+from scipy.sparse.csgraph import dijkstra
+
+
+class LikelyPathEngine:
+    """
+    Engine finding the most likely paths, as shortest paths where the length of an edge is -log of its probability.
+    A shortest path tree is searched by Dijkstra once for each source, and shared by all targets,
+    until an edge changed by update() makes it wrong. Likewise, a tree into each target is shared by all sources,
+    for enumerating paths in order of their probabilities, see iterate_paths().
+    Properties:
+        probability_matrix: scipy.sparse CSR matrix, where entry (i, j) is the probability of the edge i -> j,
+        and edges of probability 0 are left out
+        
+        searches: the number of shortest path trees searched so far
+    """
+    
+    def __init__(self, probability_matrix: sp.csr_matrix):
+        """
+        Parameters:
+            probability_matrix: scipy.sparse matrix of edge probabilities, indexed by integer ids of vertices
+        """
+        
+        self._probability_matrix = LikelyPathEngine.__get_likely_edges(probability_matrix)
+        self._cost_matrix = LikelyPathEngine.__get_costs(self._probability_matrix)
+        
+        # Shortest path trees by sources, as lengths of paths and predecessors of vertices, -9999 if none,
+        # and trees into targets, as lengths of paths and successors of vertices.
+        self._trees: dict[int, (np.ndarray, np.ndarray)] = dict()
+        self._reverse_trees: dict[int, (np.ndarray, np.ndarray)] = dict()
+        self._searches = 0
+    
+    @property
+    def probability_matrix(self) -> sp.csr_matrix:
+        """
+        Returns:
+            scipy.sparse CSR matrix, where entry (i, j) is the probability of the edge i -> j,
+            and edges of probability 0 are left out
+        """
+        return self._probability_matrix
+    
+    @property
+    def searches(self) -> int:
+        """
+        Returns:
+            the number of shortest path trees searched so far
+        """
+        return self._searches
+    
+    def get_paths(self, source: int, targets: list[int]) -> list[(list[int], float)]:
+        """
+        Get the most likely paths from a source to many targets, with one shortest path tree
+        Parameters:
+            source: integer id of the source
+            targets: integer ids of targets
+        Returns:
+            vertices of each path from the source, and the probability of the path,
+            or an empty path and probability 0 if no path has a probability above 0
+        """
+        
+        (lengths, predecessors) = self.__get_tree(source)
+        
+        paths: list[(list[int], float)] = list()
+        for target in targets:
+            if target >= len(lengths) or np.isinf(lengths[target]):
+                paths.append(([], 0.0))
+                continue
+            
+            path = [target]
+            while path[-1] != source:
+                path.append(int(predecessors[path[-1]]))
+            paths.append((path[::-1], float(np.exp(-lengths[target]))))
+        
+        return paths
+    
+    def update(self, probability_matrix: sp.csr_matrix):
+        """
+        Take new edge probabilities, where cached trees are dropped only if a changed edge makes them wrong.
+        A tree is wrong if an edge in it is changed or removed, or a changed edge from a vertex in it is shorter
+        than the path to its end vertex, while changed edges from vertices the tree never reaches make no difference.
+        Parameters:
+            probability_matrix: scipy.sparse matrix of edge probabilities, indexed by integer ids of vertices
+        """
+        
+        probability_matrix = LikelyPathEngine.__get_likely_edges(probability_matrix)
+        
+        if len(self._trees) + len(self._reverse_trees) > 0:
+            old_matrix = self._probability_matrix.copy()
+            old_matrix.resize(probability_matrix.shape)
+            changed = (probability_matrix != old_matrix).tocoo()
+            (starts, ends) = (changed.row.astype(np.int64), changed.col.astype(np.int64))
+            new_costs = np.full(len(starts), np.inf)
+            if len(starts) > 0:
+                probabilities = np.asarray(probability_matrix[starts, ends], dtype=np.float64).ravel()
+                new_costs[probabilities > 0] = -np.log(probabilities[probabilities > 0])
+            
+            # Trees into targets are trees of reversed edges.
+            LikelyPathEngine.__drop_wrong_trees(self._trees, starts, ends, new_costs, probability_matrix.shape[0])
+            LikelyPathEngine.__drop_wrong_trees(self._reverse_trees, ends, starts, new_costs,
+                                                probability_matrix.shape[0])
+        
+        self._probability_matrix = probability_matrix
+        self._cost_matrix = LikelyPathEngine.__get_costs(probability_matrix)
+    
+    def fork(self) -> 'LikelyPathEngine':
+        """
+        Fork the engine, sharing its matrices and trees, which are replaced rather than changed
+        Returns:
+            an engine updated apart from this engine
+        """
+        
+        fork = copy.copy(self)
+        fork._trees = dict(self._trees)
+        fork._reverse_trees = dict(self._reverse_trees)
+        return fork
+    
+    def iterate_paths(self, source: int, target: int, threshold: float = 0) -> Iterator[tuple[list[int], float]]:
+        """
+        Yield loopless paths from a source to a target lazily, from the most likely one, by Yen's algorithm.
+        Spur paths are searched by A* guided by the tree into the target, and the path of the tree is taken as it is,
+        when no vertex or edge removed for the spur is on it. As Lawler does, a path is only deviated
+        from vertices after where it deviates from the path it comes from, so that no spur is searched twice.
+        Paths are enumerated over edges at the time of the call, even if the engine is updated in the meantime.
+        Parameters:
+            source: integer id of the source
+            target: integer id of the target
+            threshold: the iteration stops before the first path less likely than it
+        Returns:
+            a generator of vertices of each path, and the probability of the path
+        """
+        
+        (lengths_to_target, successors) = self.__get_reverse_tree(target)
+        if source >= len(lengths_to_target) or np.isinf(lengths_to_target[source]):
+            return iter(())
+        
+        # Paths as likely as the threshold are kept, where products of probabilities are rounded.
+        max_length = -math.log(threshold) + 1e-12 if threshold > 0 else math.inf
+        cost_matrix = self._cost_matrix
+        return LikelyPathEngine.__enumerate_paths(source, target, max_length, cost_matrix.indptr.tolist(),
+                                                  cost_matrix.indices.tolist(), cost_matrix.data.tolist(),
+                                                  lengths_to_target.tolist(), successors.tolist())
+    
+    @staticmethod
+    def __enumerate_paths(source: int, target: int, max_length: float, indptr: list[int], indices: list[int],
+                          costs: list[float], heuristics: list[float],
+                          successors: list[int]) -> Iterator[tuple[list[int], float]]:
+        """
+        Yen's algorithm over a snapshot of the cost matrix, see iterate_paths()
+        Parameters:
+            source: integer id of the source
+            target: integer id of the target
+            max_length: the iteration stops before the first path longer than it
+            indptr: CSR index of the cost matrix
+            indices: end vertices of edges in the cost matrix
+            costs: lengths of edges in the cost matrix
+            heuristics: lengths of shortest paths into the target
+            successors: successors of vertices in the tree into the target
+        Returns:
+            a generator of vertices of each path, and the probability of the path
+        """
+        
+        # Next vertices of yielded paths after each of their prefixes, which spurs from the prefixes must not take.
+        next_vertices: dict[tuple[int], set[int]] = dict()
+        candidates: list[(float, int, list[int], int)] = list()
+        found: set[tuple[int]] = set()
+        
+        path = [source]
+        while path[-1] != target:
+            path.append(successors[path[-1]])
+        heapq.heappush(candidates, (heuristics[source], 0, path, 0))
+        found.add(tuple(path))
+        
+        while len(candidates) > 0:
+            
+            (length, _, path, deviation) = heapq.heappop(candidates)
+            if length > max_length:
+                return
+            yield path, math.exp(-length)
+            
+            for i in range(len(path) - 1):
+                next_vertices.setdefault(tuple(path[:i + 1]), set()).add(path[i + 1])
+            
+            root_length = 0
+            for i in range(len(path) - 1):
+                if i >= deviation:
+                    spur = LikelyPathEngine.__search_spur(path[i], target, set(path[:i]),
+                                                          next_vertices[tuple(path[:i + 1])], indptr, indices, costs,
+                                                          heuristics, successors, max_length - root_length)
+                    if spur is not None:
+                        (spur_path, spur_length) = spur
+                        candidate = path[:i] + spur_path
+                        if tuple(candidate) not in found:
+                            found.add(tuple(candidate))
+                            heapq.heappush(candidates, (root_length + spur_length, len(found), candidate, i))
+                
+                root_length += LikelyPathEngine.__get_cost(path[i], path[i + 1], indptr, indices, costs)
+    
+    def __get_tree(self, source: int) -> (np.ndarray, np.ndarray):
+        """
+        Get the cached shortest path tree of a source, or search it by Dijkstra
+        Parameters:
+            source: integer id of the source
+        Returns:
+            lengths of paths and predecessors of vertices, -9999 if none
+        """
+        
+        if source not in self._trees:
+            self._trees[source] = dijkstra(self._cost_matrix, directed=True, indices=source, return_predecessors=True)
+            self._searches += 1
+        return self._trees[source]
+    
+    def __get_reverse_tree(self, target: int) -> (np.ndarray, np.ndarray):
+        """
+        Get the cached shortest path tree into a target, or search it by Dijkstra over reversed edges
+        Parameters:
+            target: integer id of the target
+        Returns:
+            lengths of paths and successors of vertices, -9999 if none
+        """
+        
+        if target not in self._reverse_trees:
+            self._reverse_trees[target] = dijkstra(self._cost_matrix.transpose().tocsr(), directed=True,
+                                                   indices=target, return_predecessors=True)
+            self._searches += 1
+        return self._reverse_trees[target]
+    
+    @staticmethod
+    def __drop_wrong_trees(trees: dict[int, (np.ndarray, np.ndarray)], starts: np.ndarray, ends: np.ndarray,
+                           new_costs: np.ndarray, vertex_count: int):
+        """
+        Drop trees made wrong by changed edges, and extend the others to new vertices
+        Parameters:
+            trees: shortest path trees, as lengths of paths and predecessors of vertices
+            starts: start vertices of changed edges, in the direction of trees
+            ends: end vertices of changed edges, in the direction of trees
+            new_costs: new lengths of changed edges, infinite if they are removed
+            vertex_count: the number of vertices
+        """
+        
+        for root in [*trees.keys()]:
+            
+            (lengths, predecessors) = trees[root]
+            if len(lengths) < vertex_count:
+                lengths = np.concatenate([lengths, np.full(vertex_count - len(lengths), np.inf)])
+                predecessors = np.concatenate([predecessors, np.full(vertex_count - len(predecessors), -9999,
+                                                                     dtype=predecessors.dtype)])
+                trees[root] = (lengths, predecessors)
+            
+            # Removed edges have infinite costs, which never make paths shorter.
+            is_reached = ~np.isinf(lengths[starts])
+            if (is_reached & (predecessors[ends] == starts)).any() \
+                    or (is_reached & (lengths[starts] + new_costs < lengths[ends] - 1e-12)).any():
+                del trees[root]
+    
+    @staticmethod
+    def __search_spur(spur: int, target: int, removed_vertices: set[int], removed_next_vertices: set[int],
+                      indptr: list[int], indices: list[int], costs: list[float], heuristics: list[float],
+                      successors: list[int], max_length: float) -> (list[int], float):
+        """
+        Search the shortest spur path from a spur vertex to the target, by A* guided by lengths into the target
+        Parameters:
+            spur: the spur vertex
+            target: the target
+            removed_vertices: vertices of the root path before the spur
+            removed_next_vertices: ends of edges from the spur that are removed
+            indptr: CSR index of the cost matrix
+            indices: end vertices of edges in the cost matrix
+            costs: lengths of edges in the cost matrix
+            heuristics: lengths of shortest paths into the target, with no vertex or edge removed
+            successors: successors of vertices in the tree into the target
+            max_length: spur paths longer than it are not searched
+        Returns:
+            vertices of the spur path and its length, or None
+        """
+        
+        if heuristics[spur] > max_length:
+            return None
+        
+        # Removing vertices and edges never makes paths shorter, so the path of the tree is the shortest if it is left.
+        path = [spur, successors[spur]]
+        if path[1] >= 0 and path[1] not in removed_next_vertices and path[1] not in removed_vertices:
+            while path[-1] != target and path[-1] not in removed_vertices:
+                path.append(successors[path[-1]])
+            if path[-1] == target:
+                return path, heuristics[spur]
+        
+        lengths: dict[int, float] = {spur: 0}
+        predecessors: dict[int, int] = dict()
+        queue = [(heuristics[spur], 0, spur)]
+        
+        while len(queue) > 0:
+            
+            (estimate, length, vertex) = heapq.heappop(queue)
+            if estimate > max_length:
+                return None
+            
+            if vertex == target:
+                path = [target]
+                while path[-1] != spur:
+                    path.append(predecessors[path[-1]])
+                return path[::-1], length
+            
+            if length > lengths[vertex]:
+                continue
+            
+            for i in range(indptr[vertex], indptr[vertex + 1]):
+                next_vertex = indices[i]
+                if next_vertex in removed_vertices or next_vertex == spur or math.isinf(heuristics[next_vertex]) \
+                        or (vertex == spur and next_vertex in removed_next_vertices):
+                    continue
+                
+                next_length = length + costs[i]
+                if next_length < lengths.get(next_vertex, math.inf):
+                    lengths[next_vertex] = next_length
+                    predecessors[next_vertex] = vertex
+                    heapq.heappush(queue, (next_length + heuristics[next_vertex], next_length, next_vertex))
+        
+        return None
+    
+    @staticmethod
+    def __get_cost(start: int, end: int, indptr: list[int], indices: list[int], costs: list[float]) -> float:
+        """
+        Get the length of an edge from the CSR cost matrix
+        Parameters:
+            start: start vertex
+            end: end vertex
+            indptr: CSR index of the cost matrix
+            indices: end vertices of edges in the cost matrix
+            costs: lengths of edges in the cost matrix
+        Returns:
+            the length of the edge
+        """
+        return costs[indptr[start] + indices[indptr[start]:indptr[start + 1]].index(end)]
+    
+    @staticmethod
+    def __get_likely_edges(probability_matrix: sp.csr_matrix) -> sp.csr_matrix:
+        """
+        Leave edges of probability 0 out
+        Parameters:
+            probability_matrix: scipy.sparse matrix of edge probabilities
+        Returns:
+            scipy.sparse CSR matrix of edges with probabilities above 0
+        """
+        
+        probability_matrix = sp.csr_matrix(probability_matrix, copy=True)
+        probability_matrix.eliminate_zeros()
+        return probability_matrix
+    
+    @staticmethod
+    def __get_costs(probability_matrix: sp.csr_matrix) -> sp.csr_matrix:
+        """
+        Convert probabilities to lengths of edges, where edges of probability 1 are kept as explicit zeros
+        Parameters:
+            probability_matrix: scipy.sparse CSR matrix of edges with probabilities above 0
+        Returns:
+            scipy.sparse CSR matrix of -log of probabilities
+        """
+        
+        cost_matrix = probability_matrix.copy()
+        cost_matrix.data = np.maximum(-np.log(cost_matrix.data), 0)
+        return cost_matrix
@@ -17,6 +17,7 @@ Including abstract class TopologyLayer
 """
 
 import os
+import copy
 import yaml
 import time
 import networkx as nx
@@ -38,6 +39,10 @@ class TopologyLayer:
         gateway_graph: a nx.Graph object with subnets as services and gateways as edges.
         
         gateway_graph_labels: a dictionary label used for gateway_graph, like {('net1', 'net2'): 'g1'}
+        
+        service_ids: a dictionary of stable integer ids of services, like {'outside': 0, 'service1': 1}
+        
+        service_uids: a list of uids indexed by integer ids of services, like ['outside', 'service1']
     """
     
     def __init__(self, experiment_dir: str):
@@ -53,7 +58,12 @@ class TopologyLayer:
         self._topology_graph = nx.Graph()
         self._gateway_graph = nx.Graph()
         self._gateway_graph_labels = dict()
+        self._service_ids = {'outside': 0}
+        self._service_uids = ['outside']
         self._experiment_dir = experiment_dir
+        
+        # Containers are shared with forks, until either of them changes services.
+        self._shared = False
     
     @property
     def subnets(self) -> dict[str, dict[str, set]]:
@@ -103,6 +113,22 @@ class TopologyLayer:
         """
         return self._gateway_graph_labels
     
+    @property
+    def service_ids(self) -> dict[str, int]:
+        """
+        Returns:
+            service_ids: a dictionary of stable integer ids of services, like {'outside': 0, 'service1': 1}
+        """
+        return self._service_ids
+    
+    @property
+    def service_uids(self) -> list[str]:
+        """
+        Returns:
+            service_uids: a list of uids indexed by integer ids of services, like ['outside', 'service1']
+        """
+        return self._service_uids
+    
     @property
     def experiment_dir(self) -> str:
         return self._experiment_dir
@@ -131,6 +157,14 @@ class TopologyLayer:
     def gateway_graph_labels(self, gateway_graph_labels: dict[(str, str), str]):
         self._gateway_graph_labels = gateway_graph_labels
     
+    @service_ids.setter
+    def service_ids(self, service_ids: dict[str, int]):
+        self._service_ids = service_ids
+    
+    @service_uids.setter
+    def service_uids(self, service_uids: list[str]):
+        self._service_uids = service_uids
+    
     @experiment_dir.setter
     def experiment_dir(self, experiment_dir: str):
         self.experiment_dir = experiment_dir
@@ -143,7 +177,37 @@ class TopologyLayer:
             new_service: new service to add
             uid: uid of new service
         """
+        self.__unshare()
         self.services[uid] = new_service
+        self.register_service(uid)
+    
+    def fork(self) -> 'TopologyLayer':
+        """
+        Fork the topology layer, where containers are shared, and copied by whichever changes services first.
+        Integer ids are copied at once, since attack graph stores of a fork decode vertices with them.
+        Returns:
+            a topology layer changed apart from this layer
+        """
+        
+        fork = copy.copy(self)
+        fork._service_ids = dict(self._service_ids)
+        fork._service_uids = list(self._service_uids)
+        fork._shared = self._shared = True
+        return fork
+    
+    def register_service(self, uid: str) -> int:
+        """
+        Assign a stable integer id to a service.
+        Ids are never reused, so a removed service keeps its id if it is added again.
+        Parameters:
+            uid: uid of the service
+        Returns:
+            integer id of the service
+        """
+        if uid not in self.service_ids:
+            self.service_ids[uid] = len(self.service_uids)
+            self.service_uids.append(uid)
+        return self.service_ids[uid]
     
     def __delitem__(self, uid: str):
         """
@@ -158,6 +222,7 @@ class TopologyLayer:
                 Parameters:
                     uid: a service to delete by uid
                 """
+        self.__unshare()
         service_to_delete = self.services[uid]
         subnet_to_delete = service_to_delete['subnets']
     
@@ -183,6 +248,23 @@ class TopologyLayer:
     
         del self.services[uid]
     
+    def __unshare(self):
+        """
+        Copy containers shared with forks before they are changed, where services themselves are still shared
+        """
+        
+        if not self._shared:
+            return
+        
+        self._services = dict(self._services)
+        self._subnets = {subnet: {key: set(members) for key, members in self._subnets[subnet].items()}
+                         for subnet in self._subnets}
+        self._gateway_services = set(self._gateway_services)
+        self._topology_graph = self._topology_graph.copy()
+        self._gateway_graph = self._gateway_graph.copy()
+        self._gateway_graph_labels = dict(self._gateway_graph_labels)
+        self._shared = False
+    
     @staticmethod
     def get_neighbours(services: dict[str, dict[str]], subnets: dict[str, dict[str, set]], service: str) -> set[str]:
         """
@@ -274,6 +356,7 @@ class DockerComposeTopologyLayer(TopologyLayer):
         self.__parse_docker_compose_dir()
         
         for uid in self.services:
+            self.register_service(uid)
             self.__add_service_subnets(uid)
         
         dt = time.time() - time_start
@@ -17,6 +17,7 @@ Including abstract class VulnerabilityLayer
 """
 
 import os
+import copy
 import json
 import time
 import shutil
@@ -26,6 +27,9 @@ from concurrent.futures import Executor, Future, wait
 
 from layers.topology_layer import TopologyLayer, DockerComposeTopologyLayer
 
+PRIVILEGE_STRS = ('NONE', 'VOS USER', 'VOS ADMIN', 'USER', 'ADMIN')
+PRIVILEGE_VALUES = {privilege: value for value, privilege in enumerate(PRIVILEGE_STRS)}
+
 
 class VulnerabilityLayer:
     """
@@ -58,6 +62,9 @@ class VulnerabilityLayer:
         self._topology_layer = topology_layer
         self._config = config
         self._attack_vectors = attack_vectors
+        
+        # Exploitable vulnerabilities and scores are shared with forks, until either of them changes services.
+        self._shared = False
     
     @property
     def exploitable_vulnerabilities(self) -> dict[str, dict[str, dict]]:
@@ -119,6 +126,15 @@ class VulnerabilityLayer:
     def config(self, config: dict[str]):
         self._config = config
     
+    def __getstate__(self) -> dict[str]:
+        """
+        Copies sent to workers leave NVD feeds behind, which are too large to pickle for every task,
+        so that services are added to them by entries of get_exploitable(), made before they are sent.
+        """
+        state = self.__dict__.copy()
+        state['_attack_vectors'] = dict()
+        return state
+    
     @staticmethod
     def get_attack_vectors(attack_vector_path: str, executor: Executor = None) -> dict[str, dict[str]]:
         """
@@ -167,9 +183,7 @@ class VulnerabilityLayer:
             str privilege
         """
         
-        mapping = {0: 'NONE', 1: 'VOS USER', 2: 'VOS ADMIN', 3: 'USER', 4: 'ADMIN'}
-        
-        return mapping[privilege]
+        return PRIVILEGE_STRS[privilege]
     
     @staticmethod
     def get_privilege_value(privilege: str) -> int:
@@ -181,10 +195,46 @@ class VulnerabilityLayer:
             str privilege
         """
         
-        mapping = {'NONE': 0, 'VOS USER': 1, 'VOS ADMIN': 2, 'USER': 3, 'ADMIN': 4}
+        return PRIVILEGE_VALUES[privilege]
+    
+    def get_exploitable(self, task: str) -> (dict[str, dict], dict[str, int]):
+        """
+        Pre-process vulnerabilities of a task, without binding them to any service
+        Parameters:
+            task: the image a service runs, whose vulnerability report is parsed
+        Returns:
+            an entry of exploitable_vulnerabilities for services running the task, and CVSS scores of vulnerabilities
+        """
+        pass
+    
+    def set_exploitable(self, service: str, exploitable: dict[str, dict], scores: dict[str, int]):
+        """
+        Bind an entry made by get_exploitable() to a service
+        Parameters:
+            service:
+            exploitable: the entry of exploitable_vulnerabilities for the service
+            scores: CVSS scores of its vulnerabilities
+        """
         
-        return mapping[privilege]
-
+        self.__unshare()
+        self.exploitable_vulnerabilities[service] = exploitable
+        self.scores |= scores
+    
+    def fork(self) -> 'VulnerabilityLayer':
+        """
+        Fork the vulnerability layer and its topology layer, see TopologyLayer.fork().
+        Parsed reports and NVD feeds are shared, since they only depend on tasks.
+        Returns:
+            a vulnerability layer changed apart from this layer
+        """
+        
+        # copy.copy() goes through __getstate__(), which leaves NVD feeds behind.
+        fork = copy.copy(self)
+        fork._attack_vectors = self._attack_vectors
+        fork._topology_layer = self.topology_layer.fork()
+        fork._shared = self._shared = True
+        return fork
+    
     def __setitem__(self, service: str, task: str):
         pass
 
@@ -194,8 +244,19 @@ class VulnerabilityLayer:
         Parameters:
             service:
         """
+        self.__unshare()
         del self.exploitable_vulnerabilities[service]
     
+    def __unshare(self):
+        """
+        Copy exploitable vulnerabilities and scores shared with forks before they are changed
+        """
+        
+        if self._shared:
+            self._exploitable_vulnerabilities = dict(self._exploitable_vulnerabilities)
+            self._scores = dict(self._scores)
+            self._shared = False
+    
     @staticmethod
     def __add_vec_to_list(attack_vectors: dict[str, dict[str]]):
         def cbs(future: Future):
@@ -249,8 +310,6 @@ class ClairctlVulnerabilityLayer(VulnerabilityLayer):
             task:
         """
         
-        if task not in self.vulnerabilities:
-            self.vulnerabilities[task] = self.__get_single_vulnerability(task)
         self.__exploit_single_service(service)
     
     def __parse_vulnerabilities(self) -> float:
@@ -333,12 +392,21 @@ class ClairctlVulnerabilityLayer(VulnerabilityLayer):
         shutil.copy(os.path.join(self.clairctl_home, 'docker-compose-data', 'clairctl-reports', 'json',
                                  f'analysis-{task}-latest.json'), json_name)
 
-    def __exploit_single_service(self, service: str):
+    def get_exploitable(self, task: str) -> (dict[str, dict], dict[str, int]):
+        """
+        Pre-process vulnerabilities of a task, without binding them to any service
+        Parameters:
+            task:
+        Returns:
+            an entry of exploitable_vulnerabilities for services running the task, and CVSS scores of vulnerabilities
+        """
+        
+        if task not in self.vulnerabilities:
+            self.vulnerabilities[task] = self.__get_single_vulnerability(task)
         
         pre_rules = self.config['preconditions-rules']
         post_rules = self.config['postconditions-rules']
         single_label = self.config['single-edge-label']
-        task = self.topology_layer.services[service]['tasks']
         vulnerabilities = self.vulnerabilities[task]
         
         # Remove junk and just take the most important part from each vulnerability
@@ -350,7 +418,10 @@ class ClairctlVulnerabilityLayer(VulnerabilityLayer):
         # Get the preconditions and postconditions for each vulnerability.
         pre_conditions, post_conditions = self.__rule_processing(merged_vulnerabilities, pre_rules, post_rules)
         
-        exploit_ability_dict = {'pre_conditions': pre_conditions, 'post_conditions': post_conditions}
+        # CVSS scores go along with the conditions, so that workers generating attack graphs can score edges.
+        exploit_ability_dict = {'pre_conditions': pre_conditions, 'post_conditions': post_conditions,
+                                'scores': {vulnerability: vulnerability_scores[vulnerability]
+                                           for vulnerability in pre_conditions}}
         
         reverse_exploitable: dict[str, dict[int, list[str]]] = {'pre_values': {0: [], 1: [], 2: [], 3: [], 4: []},
                                                                 'post_values': {0: [], 1: [], 2: [], 3: [], 4: []}}
@@ -382,9 +453,13 @@ class ClairctlVulnerabilityLayer(VulnerabilityLayer):
                 reverse_exploitable['post_values'][post_privilege].append(vulnerability)
         
         exploit_ability_dict |= reverse_exploitable
-
-        self.exploitable_vulnerabilities[service] = exploit_ability_dict
-        self.scores |= vulnerability_scores
+        
+        return exploit_ability_dict, vulnerability_scores
+    
+    def __exploit_single_service(self, service: str):
+        
+        task = self.topology_layer.services[service]['tasks']
+        self.set_exploitable(service, *self.get_exploitable(task))
     
     def __merge_attack_vector_vulnerabilities(self, vulnerabilities):
         """Merging the information from vulnerabilities and the attack vector files."""
@@ -87,6 +87,10 @@ def do_experiment(experiment_dir: str, result_dir: str, config: dict, attack_vec
             raise ValueError(f'Vulnerability type {vulnerability_type} not implemented, '
                              f'please feel free to open Issue or PR on GitHub.')
     
+    # pre-check the highest privileges reachable on services, before generating any attack graph
+    exposure = AttackGraphLayer.summarise_exposure(vulnerability_layer)
+    wrapper.print_exposure(topology_layer, exposure)
+    
     # get attack graph layer
     attack_graph_layer = AttackGraphLayer(vulnerability_layer, executor)
     
@@ -101,12 +105,18 @@ def do_experiment(experiment_dir: str, result_dir: str, config: dict, attack_vec
 
     if config['deploy-honeypots']:
         to = config['target']
+        if to is not None and to in topology_layer.service_ids and exposure[topology_layer.service_ids[to]] < 0:
+            print(f'Target {to} is unreachable from outside, only gateways are protected.')
+            to = None
         minimum = 0
         path_counts = merged_graph_layer.gen_defence_list(to)
         
-        n1 = merged_graph_layer.service_probabilities.copy()
+        # honeypots are deployed on a fork, so that the layers without them are kept as the baseline
+        baseline_layer = merged_graph_layer
+        merged_graph_layer = baseline_layer.fork()
         merged_graph_layer.deploy_honeypot(path_counts, minimum)
-        merged_graph_layer.compare_rates(n1, merged_graph_layer.service_probabilities, to)
+        merged_graph_layer.compare_rates(baseline_layer.service_probabilities, merged_graph_layer.service_probabilities,
+                                         to)
     
     if config['draw-graphs']:
         # draw graphs
@@ -103,8 +103,10 @@ def validate_config_file() -> dict[str]:
     
     # Check if the main keywords are present in the config file.
     main_keywords = {'nvd-feed-path', 'experiment-paths', 'result-paths', 'topology-type', 'vulnerability-type',
-                     'nums-of-processes', 'draw-graphs', 'single-edge-label', 'single-exploit-per-service',
-                     'deploy-honeypots', 'target'}
+                     'nums-of-processes', 'in-process-cost-threshold', 'attack-graph-cache-path',
+                     'attack-graph-cache-size', 'attack-graph-spill-path', 'attack-graph-spill-size',
+                     'max-attack-depth', 'attack-edge-budget', 'attack-beam-width', 'draw-graphs',
+                     'single-edge-label', 'single-exploit-per-service', 'deploy-honeypots', 'target'}
     
     print('Checking data/config.yml...')
     
@@ -126,6 +128,31 @@ def validate_config_file() -> dict[str]:
         raise ValueError(f'Value \'{concurrency}\' is invalid for keyword \'nums-of-processes\', '
                          f'it must be an integer no less than 0.')
     
+    if type(threshold := config['in-process-cost-threshold']) is not int or threshold < 0:
+        raise ValueError(f'Value \'{threshold}\' is invalid for keyword \'in-process-cost-threshold\', '
+                         f'it must be an integer no less than 0.')
+    
+    if type(cache_path := config['attack-graph-cache-path']) is not str:
+        raise ValueError(f'Value \'{cache_path}\' is invalid for keyword \'attack-graph-cache-path\', '
+                         f'it must be a path.')
+    
+    if type(cache_size := config['attack-graph-cache-size']) is not int or cache_size < 0:
+        raise ValueError(f'Value \'{cache_size}\' is invalid for keyword \'attack-graph-cache-size\', '
+                         f'it must be an integer no less than 0.')
+    
+    if type(spill_path := config['attack-graph-spill-path']) is not str:
+        raise ValueError(f'Value \'{spill_path}\' is invalid for keyword \'attack-graph-spill-path\', '
+                         f'it must be a path.')
+    
+    if type(spill_size := config['attack-graph-spill-size']) is not int or spill_size < 0:
+        raise ValueError(f'Value \'{spill_size}\' is invalid for keyword \'attack-graph-spill-size\', '
+                         f'it must be an integer no less than 0.')
+    
+    for bound in ['max-attack-depth', 'attack-edge-budget', 'attack-beam-width']:
+        if type(value := config[bound]) is not int or value < 0:
+            raise ValueError(f'Value \'{value}\' is invalid for keyword \'{bound}\', '
+                             f'it must be an integer no less than 0.')
+    
     if type(draw_graphs := config['draw-graphs']) is not bool:
         raise ValueError(f'Value \'{draw_graphs}\' is invalid for keyword \'generate-graphs\', it must be bool.')
     
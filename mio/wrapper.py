@@ -16,11 +16,15 @@ This module wraps dirty works of IO like initialisation readings and file writin
 """
 
 from layers.merged_graph_layer import MergedGraphLayer
+from layers.topology_layer import TopologyLayer
+from layers.vulnerability_layer import VulnerabilityLayer
 from mio import reader, writer
 
 import time
 import os
 
+import numpy as np
+
 
 def init() -> dict[str]:
     """
@@ -101,7 +105,24 @@ def print_summary(merged_graph_layer: MergedGraphLayer):
     
     print(f'The number of nodes in the topology graph is {topology_layer.topology_graph.number_of_nodes()}')
     print(f'The number of edges in the topology graph is {topology_layer.topology_graph.number_of_edges()}')
-    print(f'The number of nodes in the composed graph is {composed_graph_layer.composed_graph.number_of_nodes()}')
-    print(f'The number of edges in the composed graph is {composed_graph_layer.composed_graph.number_of_edges()}')
+    print(f'The number of nodes in the composed graph is {composed_graph_layer.composed_store.number_of_vertices()}')
+    print(f'The number of edges in the composed graph is {composed_graph_layer.composed_store.number_of_edges()}')
     print(f'The number of nodes in the merged graph is {merged_graph_layer.merged_graph.number_of_nodes()}')
     print(f'The number of edges in the merged graph is {merged_graph_layer.merged_graph.number_of_edges()}\n\n')
+
+
+def print_exposure(topology_layer: TopologyLayer, exposure: np.ndarray):
+    """
+    print how many services an attacker can get each privilege on.
+    Parameters:
+        topology_layer: TopologyLayer
+        exposure: result of AttackGraphLayer.summarise_exposure()
+    """
+    
+    service_exposure = exposure[[topology_layer.service_ids[service] for service in topology_layer.services]]
+    
+    print(f'The number of services reachable from outside is {np.count_nonzero(service_exposure >= 0)} '
+          f'of {len(service_exposure)}')
+    for privilege in range(0, 5):
+        print(f'The number of services exposed with {VulnerabilityLayer.get_privilege_str(privilege)} is '
+              f'{np.count_nonzero(service_exposure == privilege)}')